@@ -1,16 +1,34 @@
 import asyncio
+import bisect
 import logging
+import mmap
 import os
 import random
+import secrets
 import time
 import json
-import pickle
 import signal
 import atexit
+import functools
+from collections import deque
+import heapq
+from array import array
+import queue
 import sqlite3
-from datetime import datetime, timedelta
+import struct
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -18,19 +36,40 @@ from telegram.ext import (
     ConversationHandler,
     ContextTypes,
     filters,
+    PersistenceInput,
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
+    TypeHandler,
 )
+# Обработчик вебхука PTB - для воркеров, которым не нужен set_webhook (см. run_worker)
+from telegram.ext._utils.webhookhandler import WebhookAppClass
 
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# Частые фоновые задачи и HTTP-запросы иначе засыпают лог строками на каждый вызов
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Файл для базы данных
 DB_FILE = "bot_database.db"
 
+# Шардирование: при SHARD_COUNT > 1 фронт-процесс принимает обновления и раздает
+# их по user_id рабочим процессам. SHARD_INDEX фронт задает воркеру сам
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if os.getenv("SHARD_INDEX") else None
+# Разовые задачи процесса (резервные копии, снимок индексов) - только у одного
+IS_PRIMARY_PROCESS = SHARD_INDEX in (None, 0)
+
+def shard_of(user_id):
+    """Номер воркера, которому принадлежит пользователь"""
+    return abs(user_id) % SHARD_COUNT
+
 # States for the conversation
 (
     GENDER,
@@ -60,150 +99,785 @@ DB_FILE = "bot_database.db"
 ) = range(24)
 
 # Global dictionaries to store data
-user_profiles = {}
+user_profiles = {}  # user_id -> Profile
 user_likes = {}
-user_dislikes = {}
+user_liked_by = {}  # user_id -> кто его лайкнул (обратный индекс к user_likes)
+user_dislikes = {}  # user_id -> IdSet (компактно, их много)
 matched_users = {}
 
 # Админы бота
 ADMIN_USER_IDS = [5652528225,1092924048]  # ЗАМЕНИ НА РЕАЛЬНЫЕ ID
 
+# --- ЗАПИСИ В ПАМЯТИ ---
+# Поля анкеты в порядке колонок таблицы users (после user_id)
+PROFILE_FIELDS = ('username', 'gender', 'name', 'age', 'city', 'bio', 'photo', 'created_at', 'last_active')
+_PROFILE_FIELD_SET = frozenset(PROFILE_FIELDS)
+# Поля с малым числом разных значений: храним одну копию каждого значения
+INTERNED_PROFILE_FIELDS = frozenset(('gender', 'city'))
+_interned_values = {}
+
+def _intern(value):
+    """Возвращает общий экземпляр значения (пол, курс) вместо дубликата"""
+    if value is None:
+        return None
+    return _interned_values.setdefault(value, value)
+
+# Поля, без которых анкета не показывается в поиске
+REQUIRED_PROFILE_FIELDS = ('gender', 'name', 'age', 'city', 'bio', 'photo', 'username')
+
+class Profile:
+    """Анкета пользователя: объект со __slots__ вместо dict на каждого.
+    
+    Ведет себя как dict для хендлеров: profile['name'], profile.get('bio'),
+    'photo' in profile. Незаданное поле считается отсутствующим ключом.
+    Флаг complete пересчитывается при сохранении (update_completeness),
+    а не при каждой проверке.
+    """
+    __slots__ = PROFILE_FIELDS + ('complete',)
+    
+    def __init__(self, **fields):
+        self.complete = False
+        for key, value in fields.items():
+            self[key] = value
+    
+    @classmethod
+    def from_row(cls, row):
+        """Создает анкету из строки SELECT * FROM users"""
+        profile = cls.__new__(cls)
+        for key, value in zip(PROFILE_FIELDS, row[1:]):
+            if key in INTERNED_PROFILE_FIELDS:
+                value = _intern(value)
+            object.__setattr__(profile, key, value)
+        profile.complete = False
+        profile.update_completeness()
+        return profile
+    
+    def update_completeness(self):
+        """Пересчитывает флаг complete. Возвращает изменение: -1, 0 или 1"""
+        was_complete = self.complete
+        self.complete = all(getattr(self, key, None) for key in REQUIRED_PROFILE_FIELDS)
+        return int(self.complete) - int(was_complete)
+    
+    def __getitem__(self, key):
+        if key not in _PROFILE_FIELD_SET:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def __setitem__(self, key, value):
+        if key not in _PROFILE_FIELD_SET:
+            raise KeyError(key)
+        if key in INTERNED_PROFILE_FIELDS:
+            value = _intern(value)
+        setattr(self, key, value)
+    
+    def __contains__(self, key):
+        return key in _PROFILE_FIELD_SET and hasattr(self, key)
+    
+    def get(self, key, default=None):
+        if key not in _PROFILE_FIELD_SET:
+            return default
+        return getattr(self, key, default)
+    
+    def keys(self):
+        return [key for key in PROFILE_FIELDS if hasattr(self, key)]
+    
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def __repr__(self):
+        return f"Profile({dict(self.items())!r})"
+
+class IdSet:
+    """Компактное множество id пользователей на отсортированном array('q').
+    
+    8 байт на элемент против ~70 у set из int. Поиск - бинарный, вставка
+    сдвигает хвост массива, что для списков дизлайков одного человека дешево.
+    """
+    __slots__ = ('_ids',)
+    
+    def __init__(self, ids=()):
+        self._ids = array('q', sorted(set(ids)))
+    
+    @classmethod
+    def from_sorted(cls, ids):
+        """Оборачивает уже отсортированный array('q') без уникальных повторов, без копирования"""
+        id_set = cls.__new__(cls)
+        id_set._ids = ids
+        return id_set
+    
+    def __contains__(self, user_id):
+        ids = self._ids
+        i = bisect.bisect_left(ids, user_id)
+        return i < len(ids) and ids[i] == user_id
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    def __iter__(self):
+        return iter(self._ids)
+    
+    def add(self, user_id):
+        ids = self._ids
+        i = bisect.bisect_left(ids, user_id)
+        if i == len(ids) or ids[i] != user_id:
+            ids.insert(i, user_id)
+    
+    def discard(self, user_id):
+        ids = self._ids
+        i = bisect.bisect_left(ids, user_id)
+        if i < len(ids) and ids[i] == user_id:
+            del ids[i]
+    
+    def clear(self):
+        self._ids = array('q')
+
+# --- СТАТИСТИКА ---
+# За сколько последних дней показывать новых пользователей
+STATS_NEW_USERS_DAYS = 7
+
+def _stats_day(timestamp):
+    """'YYYY-MM-DD HH:MM:SS' (UTC, как пишет SQLite) -> 'YYYY-MM-DD'"""
+    return timestamp[:10] if timestamp else None
+
+def _stats_sort_key(value):
+    # None первым, как NULL в ORDER BY; числа и строки не сравниваем между собой
+    return (value is not None, isinstance(value, str), value if value is not None else 0)
+
+class BotStats:
+    """Счетчики для админки, которые обновляются по событиям, а не пересчетом.
+    
+    Анкеты меняются на месте, поэтому для каждого пользователя помним,
+    в какие корзины он уже посчитан, и при изменении переносим его вклад.
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.total_likes = 0
+        # Связи в matched_users: по две на каждое совпадение
+        self.match_links = 0
+        self.complete_profiles = 0
+        self.gender = {}
+        self.age = {}
+        self.course = {}
+        self.new_by_day = {}
+        # Пользователи по дню последней активности: каждый посчитан в одном дне
+        self.active_by_day = {}
+        self._counted = {}  # user_id -> вклад анкеты (см. update_profile)
+    
+    def rebuild(self, profiles, likes, matches):
+        """Пересчитывает все с нуля - после загрузки данных целиком"""
+        self.reset()
+        for user_id, profile in profiles.items():
+            self.update_profile(user_id, profile)
+        self.total_likes = sum(len(liked) for liked in likes.values())
+        self.match_links = sum(len(matched) for matched in matches.values())
+    
+    @property
+    def total_matches(self):
+        return self.match_links // 2
+    
+    @staticmethod
+    def _bump(counter, key, delta):
+        value = counter.get(key, 0) + delta
+        if value:
+            counter[key] = value
+        else:
+            counter.pop(key, None)
+    
+    def update_profile(self, user_id, profile):
+        """Переносит вклад анкеты в счетчики; вызывать после каждого ее изменения"""
+        contribution = (
+            profile.get('gender'), profile.get('age'), profile.get('city'), profile.complete,
+            _stats_day(profile.get('created_at')), _stats_day(profile.get('last_active')),
+        )
+        old = self._counted.get(user_id)
+        if old == contribution:
+            return
+        if old is not None:
+            self._apply(old, -1)
+        self._apply(contribution, 1)
+        self._counted[user_id] = contribution
+    
+    def _apply(self, contribution, delta):
+        gender, age, course, complete, created_day, active_day = contribution
+        self._bump(self.gender, gender, delta)
+        self._bump(self.age, age, delta)
+        self._bump(self.course, course, delta)
+        if complete:
+            self.complete_profiles += delta
+        if created_day:
+            self._bump(self.new_by_day, created_day, delta)
+        if active_day:
+            self._bump(self.active_by_day, active_day, delta)
+    
+    @staticmethod
+    def histogram(counter):
+        """[(значение, количество)] по возрастанию значения"""
+        return sorted(counter.items(), key=lambda item: _stats_sort_key(item[0]))
+    
+    def new_users(self, days=STATS_NEW_USERS_DAYS):
+        """Зарегистрировавшиеся за последние days календарных дней (UTC)"""
+        now = time.time()
+        return sum(
+            self.new_by_day.get(time.strftime('%Y-%m-%d', time.gmtime(now - offset * 86400)), 0)
+            for offset in range(days)
+        )
+    
+    def active_today(self):
+        """Пользователи, чей last_active приходится на сегодня (UTC)"""
+        return self.active_by_day.get(time.strftime('%Y-%m-%d', time.gmtime()), 0)
+
+bot_stats = BotStats()
+
 # --- БАЗА ДАННЫХ SQLite ---
+# Размер пула постоянных соединений с БД
+DB_POOL_SIZE = 4
+# Сколько подготовленных выражений кэшировать на одно соединение
+DB_STATEMENT_CACHE_SIZE = 128
+# Сколько ждать блокировку БД, прежде чем упасть с ошибкой (секунды)
+DB_BUSY_TIMEOUT = 5
+
+# Запросы, которые выполняются и напрямую, и пачками из очереди отложенной записи
+# UPSERT, а не INSERT OR REPLACE: REPLACE удаляет строку и сбрасывает created_at
+SQL_SAVE_USER = '''
+    INSERT INTO users 
+    (user_id, username, gender, name, age, city, bio, photo, last_active)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        gender = excluded.gender,
+        name = excluded.name,
+        age = excluded.age,
+        city = excluded.city,
+        bio = excluded.bio,
+        photo = excluded.photo,
+        last_active = CURRENT_TIMESTAMP
+'''
+SQL_ADD_LIKE = 'INSERT OR IGNORE INTO likes (liker_id, liked_id) VALUES (?, ?)'
+SQL_ADD_MATCH = 'INSERT OR IGNORE INTO matches (user1_id, user2_id) VALUES (?, ?)'
+SQL_ADD_DISLIKE = 'INSERT OR IGNORE INTO dislikes (disliker_id, disliked_id) VALUES (?, ?)'
+SQL_CLEAR_DISLIKES = 'DELETE FROM dislikes WHERE disliker_id = ?'
+SQL_CLEAR_LIKES = 'DELETE FROM likes WHERE liker_id = ?'
+SQL_CLEAR_MATCHES = 'DELETE FROM matches WHERE user1_id = ? OR user2_id = ?'
+SQL_ENQUEUE_NOTIFICATION = 'INSERT INTO outbox (chat_id, kind, subject_id, next_attempt_at) VALUES (?, ?, ?, ?)'
+# Сессии (user_data) и состояния диалогов для SQLitePersistence
+SQL_SAVE_SESSION = '''
+    INSERT INTO user_sessions (user_id, data) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+'''
+SQL_DROP_SESSION = 'DELETE FROM user_sessions WHERE user_id = ?'
+SQL_SAVE_CONVERSATION = '''
+    INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+    ON CONFLICT(name, key) DO UPDATE SET state = excluded.state
+'''
+SQL_END_CONVERSATION = 'DELETE FROM conversations WHERE name = ? AND key = ?'
+# Виды уведомлений в outbox: subject_id - чья анкета / с кем совпадение
+OUTBOX_LIKE = 'like'
+OUTBOX_MATCH = 'match'
+# Сколько строк читать за раз при массовой загрузке
+DB_FETCH_BATCH = 10000
+
+# Миграции схемы: (версия, описание, SQL). Номер последней примененной
+# хранится в PRAGMA user_version, на старой БД выполняются только новые.
+# Выпущенные миграции не меняем - только дописываем новые в конец.
+SCHEMA_MIGRATIONS = (
+    (1, "users by last_active for incremental sync", (
+        'CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active)',
+    )),
+    (2, "likes by liked_id", (
+        'CREATE INDEX IF NOT EXISTS idx_likes_liked ON likes(liked_id, liker_id)',
+    )),
+    # user_id - это rowid и так есть в индексе, unbanned_at нужен, чтобы индекс был покрывающим
+    (3, "active bans ordered by date (covering)", (
+        '''CREATE INDEX IF NOT EXISTS idx_bans_active
+           ON bans(banned_at, username, reason, unbanned_at) WHERE unbanned_at IS NULL''',
+    )),
+    (4, "users by created_at", (
+        'CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)',
+    )),
+    # Уведомления пишутся в одной транзакции с лайком/совпадением, отправляются фоном.
+    # next_attempt_at - время (epoch), раньше которого строку не берем; status: pending/dead
+    (5, "notification outbox", (
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            subject_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        """CREATE INDEX IF NOT EXISTS idx_outbox_due
+           ON outbox(next_attempt_at) WHERE status = 'pending'""",
+    )),
+    # data - user_data в JSON; key диалога - JSON-список (chat_id, user_id)
+    (6, "user sessions and conversation states", (
+        '''CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state INTEGER,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID''',
+    )),
+    # Удаленные лайки/совпадения/дизлайки (/clear, /reset): по этому журналу
+    # синхронизация убирает их из памяти других процессов. Пишут триггеры,
+    # поэтому в журнал попадает любое удаление, в том числе из очереди записи
+    (7, "log of deleted likes, matches and dislikes", (
+        '''CREATE TABLE IF NOT EXISTS deletions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_deletions_created_at ON deletions(created_at)',
+        '''CREATE TRIGGER IF NOT EXISTS likes_deleted AFTER DELETE ON likes BEGIN
+            INSERT INTO deletions (kind, user1_id, user2_id) VALUES ('like', OLD.liker_id, OLD.liked_id);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS matches_deleted AFTER DELETE ON matches BEGIN
+            INSERT INTO deletions (kind, user1_id, user2_id) VALUES ('match', OLD.user1_id, OLD.user2_id);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS dislikes_deleted AFTER DELETE ON dislikes BEGIN
+            INSERT INTO deletions (kind, user1_id, user2_id) VALUES ('dislike', OLD.disliker_id, OLD.disliked_id);
+        END''',
+    )),
+)
+# Сколько хранить журнал удалений: работающие процессы читают его каждую
+# секунду, а перезапущенный загружает данные заново и старые записи не читает
+DELETIONS_KEEP = 24 * 60 * 60
+# Как часто чистить журнал удалений (секунды)
+DELETIONS_PRUNE_INTERVAL = 60 * 60
+
 class Database:
-    def __init__(self, db_file):
+    def __init__(self, db_file, pool_size=DB_POOL_SIZE):
         self.db_file = db_file
         # Создаем папку если нужно
         os.makedirs(os.path.dirname(db_file) if os.path.dirname(db_file) else '.', exist_ok=True)
+        # LIFO, чтобы чаще переиспользовать "тёплые" соединения с прогретым кэшем
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._pool_size = pool_size
+        self._pool_created = 0
+        self._pool_lock = threading.Lock()
         self.init_db()
+        
+        # Отдельное соединение для PRAGMA data_version: значение меняется,
+        # когда любое другое соединение (или другой процесс) делает commit
+        self._sync_conn = self._connect()
+        self._sync_lock = threading.Lock()
+        self._synced_version = None
+        # Водяные знаки: до каких строк данные уже загружены в память
+        self._users_watermark = None
+        self._likes_watermark = 0
+        self._matches_watermark = 0
+        self._dislikes_watermark = 0
+        self._deletions_watermark = 0
+    
+    # --- ПУЛ СОЕДИНЕНИЙ ---
+    def _connect(self):
+        """Открывает новое соединение и настраивает его PRAGMA"""
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        # WAL: читатели не блокируют писателя, commit без полного fsync журнала
+        conn.execute('PRAGMA journal_mode=WAL')
+        # В режиме WAL NORMAL безопасен при падении процесса и сильно дешевле FULL
+        conn.execute('PRAGMA synchronous=NORMAL')
+        # ~8 МБ страничного кэша на соединение
+        conn.execute('PRAGMA cache_size=-8000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT * 1000}')
+        return conn
+    
+    def _acquire(self):
+        """Берет соединение из пула, при необходимости открывает новое"""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._pool_lock:
+            if self._pool_created < self._pool_size:
+                self._pool_created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._pool_created -= 1
+                    raise
+        
+        # Пул исчерпан - ждем, пока кто-нибудь вернет соединение
+        return self._pool.get()
+    
+    def _release(self, conn):
+        """Возвращает соединение в пул"""
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+            with self._pool_lock:
+                self._pool_created -= 1
+    
+    @contextmanager
+    def connection(self):
+        """Выдает соединение из пула: commit при успехе, rollback при ошибке"""
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+    
+    def close(self):
+        """Закрывает все соединения пула"""
+        self._sync_conn.close()
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._pool_lock:
+                self._pool_created -= 1
     
     def init_db(self):
         """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                gender TEXT,
-                name TEXT,
-                age INTEGER,
-                city INTEGER,
-                bio TEXT,
-                photo TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица лайков
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS likes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                liker_id INTEGER,
-                liked_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(liker_id, liked_id)
-            )
-        ''')
-        
-        # Таблица совпадений
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS matches (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user1_id INTEGER,
-                user2_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user1_id, user2_id)
-            )
-        ''')
-        
-        # Таблица настроек бота
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bot_settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                maintenance_mode BOOLEAN DEFAULT 0,
-                maintenance_message TEXT,
-                maintenance_end TIMESTAMP
-            )
-        ''')
-        
-        # Таблица банов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bans (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                reason TEXT,
-                banned_by INTEGER,
-                banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                unbanned_at TIMESTAMP NULL
-            )
-        ''')
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Таблица пользователей
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    gender TEXT,
+                    name TEXT,
+                    age INTEGER,
+                    city INTEGER,
+                    bio TEXT,
+                    photo TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Таблица лайков
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS likes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    liker_id INTEGER,
+                    liked_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(liker_id, liked_id)
+                )
+            ''')
+            
+            # Таблица совпадений
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS matches (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user1_id INTEGER,
+                    user2_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(user1_id, user2_id)
+                )
+            ''')
+            
+            # Таблица дизлайков
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS dislikes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    disliker_id INTEGER,
+                    disliked_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(disliker_id, disliked_id)
+                )
+            ''')
+            
+            # Таблица настроек бота
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_settings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    maintenance_mode BOOLEAN DEFAULT 0,
+                    maintenance_message TEXT,
+                    maintenance_end TIMESTAMP
+                )
+            ''')
+            
+            # Таблица банов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bans (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    reason TEXT,
+                    banned_by INTEGER,
+                    banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    unbanned_at TIMESTAMP NULL
+                )
+            ''')
+            
+            # Инициализируем настройки
+            cursor.execute('INSERT OR IGNORE INTO bot_settings (id, maintenance_mode) VALUES (1, 0)')
         
-        # Инициализируем настройки
-        cursor.execute('INSERT OR IGNORE INTO bot_settings (id, maintenance_mode) VALUES (1, 0)')
+        with self.connection() as conn:
+            self.migrate(conn)
         
-        conn.commit()
-        conn.close()
         logger.info("Database initialized successfully")
     
+    def migrate(self, conn):
+        """Применяет миграции новее PRAGMA user_version, каждую в своей транзакции"""
+        latest = SCHEMA_MIGRATIONS[-1][0]
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            # Версию перечитываем под блокировкой записи: если БД обновил
+            # другой процесс, миграция не применится дважды
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                current = conn.execute('PRAGMA user_version').fetchone()[0]
+                if current > latest:
+                    raise RuntimeError(f"Database schema version {current} is newer than supported {latest}")
+                if current >= version:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"Applied schema migration {version}: {description}")
+    
     def load_all_data(self):
         """Загружает все данные из базы в память"""
-        global user_profiles, user_likes, matched_users
+        self.merge_loaded_data(self.fetch_all_data())
+        logger.info(f"Loaded from DB: {len(user_profiles)} users, {len(user_likes)} like relations")
+    
+    def fetch_all_data(self):
+        """Читает пользователей, лайки, совпадения и дизлайки из базы (без изменения памяти).
+        
+        Удалений в ответе нет (пустой список): удаленных строк и так не прочитаем.
+        """
+        with self._sync_lock:
+            version = self._data_version()
+            with self.connection() as conn:
+                # Сначала фиксируем границы, потом читаем строки не дальше них:
+                # все, что запишут после, подтянет следующая синхронизация.
+                # Знак удалений - первым: удаление после него придет повторно, а не потеряется
+                deletions_max = self._deletions_max(conn)
+                likes_max, matches_max, dislikes_max, users_max = self._current_watermarks(conn)
+                users = conn.execute('SELECT * FROM users').fetchall()
+                likes = conn.execute(
+                    'SELECT liker_id, liked_id FROM likes WHERE id <= ?', (likes_max,)
+                ).fetchall()
+                matches = conn.execute(
+                    'SELECT user1_id, user2_id FROM matches WHERE id <= ?', (matches_max,)
+                ).fetchall()
+                dislikes = self._fetch_dislikes(conn, 0, dislikes_max)
+            
+            self._synced_version = version
+            self._likes_watermark = likes_max
+            self._matches_watermark = matches_max
+            self._dislikes_watermark = dislikes_max
+            self._deletions_watermark = deletions_max
+            self._users_watermark = users_max
+        return users, likes, matches, dislikes, []
+    
+    def fetch_changes(self):
+        """Читает только строки, изменившиеся с прошлой синхронизации.
+        
+        Возвращает None, если с тех пор в БД никто ничего не записывал.
+        """
+        if self._users_watermark is None:
+            return self.fetch_all_data()
+        
+        with self._sync_lock:
+            version = self._data_version()
+            if version == self._synced_version:
+                return None
+            
+            with self.connection() as conn:
+                deletions_max = self._deletions_max(conn)
+                likes_max, matches_max, dislikes_max, users_max = self._current_watermarks(conn)
+                # last_active хранится с точностью до секунды, поэтому >=:
+                # повторно прочитать пару строк дешевле, чем потерять обновление
+                users = conn.execute(
+                    'SELECT * FROM users WHERE last_active >= ?', (self._users_watermark,)
+                ).fetchall()
+                likes = conn.execute(
+                    'SELECT liker_id, liked_id FROM likes WHERE id > ? AND id <= ?',
+                    (self._likes_watermark, likes_max)
+                ).fetchall()
+                matches = conn.execute(
+                    'SELECT user1_id, user2_id FROM matches WHERE id > ? AND id <= ?',
+                    (self._matches_watermark, matches_max)
+                ).fetchall()
+                dislikes = self._fetch_dislikes(conn, self._dislikes_watermark, dislikes_max)
+                deletions = conn.execute(
+                    'SELECT kind, user1_id, user2_id FROM deletions WHERE id > ? AND id <= ? ORDER BY id',
+                    (self._deletions_watermark, deletions_max)
+                ).fetchall()
+            
+            self._synced_version = version
+            self._likes_watermark = likes_max
+            self._matches_watermark = matches_max
+            self._dislikes_watermark = dislikes_max
+            self._deletions_watermark = deletions_max
+            self._users_watermark = max(users_max, self._users_watermark)
+        return users, likes, matches, dislikes, deletions
+    
+    def resume_from_snapshot(self, marks, counts):
+        """Продолжает синхронизацию с водяных знаков снимка.
+        
+        counts - число лайков, совпадений и дизлайков не дальше знаков на момент снимка.
+        Возвращает False, если снимок не подходит к этой БД: ее откатили
+        (например, восстановили из бэкапа) или после снимка удаляли строки до знака.
+        """
+        likes_mark, matches_mark, dislikes_mark, users_mark = marks
+        with self._sync_lock:
+            with self.connection() as conn:
+                likes_max, matches_max, dislikes_max, users_max = self._current_watermarks(conn)
+                if (likes_mark > likes_max or matches_mark > matches_max
+                        or dislikes_mark > dislikes_max or users_mark > users_max):
+                    return False
+                if self.count_up_to_marks(conn, marks) != tuple(counts):
+                    return False
+                # Удаления строк новее знаков в снимке и так не отражены
+                deletions_max = self._deletions_max(conn)
+            
+            # Следующий fetch_changes прочитает все, что записано после снимка
+            self._synced_version = None
+            self._likes_watermark = likes_mark
+            self._matches_watermark = matches_mark
+            self._dislikes_watermark = dislikes_mark
+            self._deletions_watermark = deletions_max
+            self._users_watermark = users_mark
+        return True
+    
+    @staticmethod
+    def count_up_to_marks(conn, marks):
+        """Число лайков, совпадений и дизлайков с id не дальше водяных знаков.
+        
+        Удаления (/clear, /reset) не двигают знаки - их видно только по этим счетчикам.
+        """
+        likes_mark, matches_mark, dislikes_mark, _users_mark = marks
+        return (
+            conn.execute('SELECT COUNT(*) FROM likes WHERE id <= ?', (likes_mark,)).fetchone()[0],
+            conn.execute('SELECT COUNT(*) FROM matches WHERE id <= ?', (matches_mark,)).fetchone()[0],
+            conn.execute('SELECT COUNT(*) FROM dislikes WHERE id <= ?', (dislikes_mark,)).fetchone()[0],
+        )
+    
+    def _data_version(self):
+        """Счетчик изменений БД, сделанных другими соединениями"""
+        return self._sync_conn.execute('PRAGMA data_version').fetchone()[0]
+    
+    @staticmethod
+    def _deletions_max(conn):
+        """Последний id в журнале удалений"""
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM deletions').fetchone()[0]
+    
+    @staticmethod
+    def _current_watermarks(conn):
+        """Текущие максимальные id лайков/совпадений/дизлайков и last_active пользователей"""
+        likes_max = conn.execute('SELECT COALESCE(MAX(id), 0) FROM likes').fetchone()[0]
+        matches_max = conn.execute('SELECT COALESCE(MAX(id), 0) FROM matches').fetchone()[0]
+        dislikes_max = conn.execute('SELECT COALESCE(MAX(id), 0) FROM dislikes').fetchone()[0]
+        users_max = conn.execute("SELECT COALESCE(MAX(last_active), '') FROM users").fetchone()[0]
+        return likes_max, matches_max, dislikes_max, users_max
+    
+    @staticmethod
+    def _fetch_dislikes(conn, after_id, up_to_id):
+        """Читает дизлайки пачками сразу в массивы: {disliker_id: array('q') по возрастанию}"""
+        cursor = conn.execute('''
+            SELECT disliker_id, disliked_id FROM dislikes
+            WHERE id > ? AND id <= ?
+            ORDER BY disliker_id, disliked_id
+        ''', (after_id, up_to_id))
         
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+        dislikes = {}
+        current_id = None
+        current = None
+        while True:
+            rows = cursor.fetchmany(DB_FETCH_BATCH)
+            if not rows:
+                break
+            for disliker_id, disliked_id in rows:
+                if disliker_id != current_id:
+                    current_id = disliker_id
+                    current = dislikes[disliker_id] = array('q')
+                current.append(disliked_id)
+        return dislikes
+    
+    def merge_loaded_data(self, data, is_user_pending=None):
+        """Вливает прочитанные из базы строки в глобальные словари.
+        
+        is_user_pending(user_id) -> True, если в памяти уже есть более свежая,
+        еще не записанная версия профиля: такие строки из БД пропускаем.
+        """
+        users, likes, matches, dislikes, deletions = data
+        
+        # Сначала удаления: строка, удаленная и добавленная заново, придет
+        # в likes/matches/dislikes и вернется в память ниже
+        for kind, user1_id, user2_id in deletions:
+            if kind == 'like':
+                forget_like(user1_id, user2_id)
+            elif kind == 'match':
+                forget_match(user1_id, user2_id)
+            elif kind == 'dislike':
+                disliked = user_dislikes.get(user1_id)
+                if disliked is not None:
+                    disliked.discard(user2_id)
         
         # Загружаем пользователей
-        cursor.execute('SELECT * FROM users')
-        users = cursor.fetchall()
         for user in users:
             user_id = user[0]
-            user_profiles[user_id] = {
-                'username': user[1],
-                'gender': user[2],
-                'name': user[3],
-                'age': user[4],
-                'city': user[5],
-                'bio': user[6],
-                'photo': user[7],
-                'created_at': user[8],
-                'last_active': user[9]
-            }
+            if is_user_pending and is_user_pending(user_id):
+                continue
+            profile = user_profiles[user_id] = Profile.from_row(user)
+            bot_stats.update_profile(user_id, profile)
         
         # Загружаем лайки
-        cursor.execute('SELECT liker_id, liked_id FROM likes')
-        likes = cursor.fetchall()
         for liker_id, liked_id in likes:
-            if liker_id not in user_likes:
-                user_likes[liker_id] = set()
-            user_likes[liker_id].add(liked_id)
+            remember_like(liker_id, liked_id)
         
         # Загружаем совпадения
-        cursor.execute('SELECT user1_id, user2_id FROM matches')
-        matches = cursor.fetchall()
         for user1_id, user2_id in matches:
-            if user1_id not in matched_users:
-                matched_users[user1_id] = set()
-            if user2_id not in matched_users:
-                matched_users[user2_id] = set()
-            matched_users[user1_id].add(user2_id)
-            matched_users[user2_id].add(user1_id)
+            remember_match(user1_id, user2_id)
         
-        conn.close()
-        logger.info(f"Loaded from DB: {len(user_profiles)} users, {len(user_likes)} like relations")
-    
-    def save_user(self, user_id, profile_data):
-        """Сохраняет/обновляет пользователя в БД"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO users 
-            (user_id, username, gender, name, age, city, bio, photo, last_active)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (
+        # Загружаем дизлайки
+        for disliker_id, disliked_ids in dislikes.items():
+            existing = user_dislikes.get(disliker_id)
+            if existing is None:
+                user_dislikes[disliker_id] = IdSet.from_sorted(disliked_ids)
+            else:
+                for disliked_id in disliked_ids:
+                    existing.add(disliked_id)
+    
+    @staticmethod
+    def user_row(user_id, profile_data):
+        """Готовит параметры SQL_SAVE_USER из профиля"""
+        return (
             user_id,
             profile_data.get('username'),
             profile_data.get('gender'),
@@ -212,54 +886,153 @@ class Database:
             profile_data.get('city'),
             profile_data.get('bio'),
             profile_data.get('photo')
-        ))
-        
-        conn.commit()
-        conn.close()
+        )
     
-    def add_like(self, liker_id, liked_id):
-        """Добавляет лайк в БД"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+    def save_user(self, user_id, profile_data):
+        """Сохраняет/обновляет пользователя в БД"""
+        with self.connection() as conn:
+            conn.execute(SQL_SAVE_USER, self.user_row(user_id, profile_data))
+    
+    def like_and_match(self, liker_id, liked_id):
+        """Лайк, проверка встречного лайка и совпадение - одной транзакцией.
         
+        Возвращает True, только если совпадение создано именно этим вызовом:
+        из двух одновременных встречных лайков его получит ровно один.
+        Уведомления (о лайке или обоим о совпадении) пишутся в outbox в той же транзакции.
+        """
+        u1, u2 = sorted([liker_id, liked_id])
+        now = time.time()
         try:
-            cursor.execute(
-                'INSERT OR IGNORE INTO likes (liker_id, liked_id) VALUES (?, ?)',
-                (liker_id, liked_id)
-            )
-            conn.commit()
+            with self.connection() as conn:
+                # Блокировка записи сразу: встречный лайк не проскочит между проверкой и вставкой
+                conn.execute('BEGIN IMMEDIATE')
+                new_like = conn.execute(SQL_ADD_LIKE, (liker_id, liked_id)).rowcount == 1
+                mutual = conn.execute(
+                    'SELECT 1 FROM likes WHERE liker_id = ? AND liked_id = ?', (liked_id, liker_id)
+                ).fetchone()
+                if not mutual:
+                    # Повторный лайк той же анкеты второй раз не уведомляет
+                    if new_like:
+                        conn.execute(SQL_ENQUEUE_NOTIFICATION, (liked_id, OUTBOX_LIKE, liker_id, now))
+                    return False
+                if conn.execute(SQL_ADD_MATCH, (u1, u2)).rowcount != 1:
+                    return False
+                conn.executemany(SQL_ENQUEUE_NOTIFICATION, [
+                    (liker_id, OUTBOX_MATCH, liked_id, now),
+                    (liked_id, OUTBOX_MATCH, liker_id, now),
+                ])
+                return True
         except Exception as e:
-            logger.error(f"Error saving like to DB: {e}")
-        finally:
-            conn.close()
+            logger.error(f"Error saving like/match to DB: {e}")
+            raise
     
-    def add_match(self, user1_id, user2_id):
-        """Добавляет совпадение в БД"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        # Убедимся, что user1_id всегда меньше user2_id для уникальности
-        u1, u2 = sorted([user1_id, user2_id])
-        
+    def add_dislike(self, disliker_id, disliked_id):
+        """Добавляет дизлайк в БД"""
         try:
-            cursor.execute(
-                'INSERT OR IGNORE INTO matches (user1_id, user2_id) VALUES (?, ?)',
-                (u1, u2)
-            )
-            conn.commit()
+            with self.connection() as conn:
+                conn.execute(SQL_ADD_DISLIKE, (disliker_id, disliked_id))
         except Exception as e:
-            logger.error(f"Error saving match to DB: {e}")
-        finally:
-            conn.close()
+            logger.error(f"Error saving dislike to DB: {e}")
+    
+    def clear_dislikes(self, disliker_id):
+        """Удаляет все дизлайки пользователя из БД"""
+        with self.connection() as conn:
+            conn.execute(SQL_CLEAR_DISLIKES, (disliker_id,))
+    
+    def clear_likes(self, liker_id):
+        """Удаляет все лайки пользователя из БД"""
+        with self.connection() as conn:
+            conn.execute(SQL_CLEAR_LIKES, (liker_id,))
+    
+    def clear_matches(self, user_id):
+        """Удаляет все совпадения пользователя из БД (для обеих сторон)"""
+        with self.connection() as conn:
+            conn.execute(SQL_CLEAR_MATCHES, (user_id, user_id))
+    
+    def prune_deletions(self, keep=DELETIONS_KEEP):
+        """Удаляет из журнала удалений записи старше keep секунд. Возвращает их число"""
+        with self.connection() as conn:
+            return conn.execute(
+                "DELETE FROM deletions WHERE created_at < datetime('now', ?)", (f'-{keep} seconds',)
+            ).rowcount
+    
+    # --- OUTBOX УВЕДОМЛЕНИЙ ---
+    def claim_outbox(self, limit, lease, shard_count=1, shard_index=0):
+        """Забирает до limit готовых к отправке строк и откладывает их на lease секунд.
+        
+        Если процесс упадет посреди отправки, строки вернутся в работу после lease.
+        При шардировании берутся только строки для чатов своего воркера (см. shard_of).
+        """
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('''
+                SELECT id, chat_id, kind, subject_id, attempts FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ? AND abs(chat_id) % ? = ?
+                ORDER BY next_attempt_at LIMIT ?
+            ''', (now, shard_count, shard_index, limit)).fetchall()
+            conn.executemany(
+                'UPDATE outbox SET next_attempt_at = ? WHERE id = ?', [(now + lease, row[0]) for row in rows]
+            )
+        return rows
+    
+    def settle_outbox(self, delivered, retries, dead):
+        """Записывает итоги отправки: доставленные удаляет, остальные переносит или хоронит"""
+        with self.connection() as conn:
+            conn.executemany('DELETE FROM outbox WHERE id = ?', [(outbox_id,) for outbox_id in delivered])
+            conn.executemany(
+                'UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?', retries
+            )
+            conn.executemany(
+                "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?", dead
+            )
+    
+    def next_outbox_due(self):
+        """Время (epoch) ближайшей отложенной отправки или None, если outbox пуст"""
+        with self.connection() as conn:
+            return conn.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+            ).fetchone()[0]
+    
+    def outbox_counts(self):
+        """Число строк outbox по статусам"""
+        with self.connection() as conn:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+    
+    # --- СЕССИИ И ДИАЛОГИ ---
+    def save_session(self, user_id, data):
+        with self.connection() as conn:
+            conn.execute(SQL_SAVE_SESSION, (user_id, data))
+    
+    def drop_session(self, user_id):
+        with self.connection() as conn:
+            conn.execute(SQL_DROP_SESSION, (user_id,))
+    
+    def save_conversation(self, name, key, state):
+        with self.connection() as conn:
+            conn.execute(SQL_SAVE_CONVERSATION, (name, key, state))
+    
+    def end_conversation(self, name, key):
+        with self.connection() as conn:
+            conn.execute(SQL_END_CONVERSATION, (name, key))
+    
+    def get_session(self, user_id):
+        """user_data пользователя в JSON или None"""
+        with self.connection() as conn:
+            row = conn.execute('SELECT data FROM user_sessions WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+    
+    def get_conversations(self, name):
+        """Все незавершенные диалоги: [(key в JSON, state)]"""
+        with self.connection() as conn:
+            return conn.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
     
     def get_maintenance_status(self):
         """Проверяет статус техобслуживания"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT maintenance_mode, maintenance_message, maintenance_end FROM bot_settings WHERE id = 1')
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            result = conn.execute(
+                'SELECT maintenance_mode, maintenance_message, maintenance_end FROM bot_settings WHERE id = 1'
+            ).fetchone()
         
         if result:
             return {
@@ -271,115 +1044,1117 @@ class Database:
     
     def set_maintenance_mode(self, enabled, message=None, end_time=None):
         """Устанавливает режим техобслуживания"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE bot_settings 
-            SET maintenance_mode = ?, maintenance_message = ?, maintenance_end = ?
-            WHERE id = 1
-        ''', (1 if enabled else 0, message, end_time))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute('''
+                UPDATE bot_settings 
+                SET maintenance_mode = ?, maintenance_message = ?, maintenance_end = ?
+                WHERE id = 1
+            ''', (1 if enabled else 0, message, end_time))
 
     # --- ФУНКЦИИ ДЛЯ БАНОВ ---
-    def is_user_banned(self, user_id):
-        """Проверяет, забанен ли пользователь"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT user_id FROM bans WHERE user_id = ? AND unbanned_at IS NULL', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        
-        return result is not None
-
     def ban_user(self, user_id, username, reason, admin_id):
         """Банит пользователя"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO bans (user_id, username, reason, banned_by) 
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, username, reason, admin_id))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO bans (user_id, username, reason, banned_by) 
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, username, reason, admin_id))
 
     def unban_user(self, user_id):
         """Разбанивает пользователя"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('UPDATE bans SET unbanned_at = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute('UPDATE bans SET unbanned_at = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
 
     def get_banned_users(self):
         """Получает список забаненных пользователей"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT user_id, username, reason, banned_at 
-            FROM bans 
-            WHERE unbanned_at IS NULL 
-            ORDER BY banned_at DESC
-        ''')
-        banned_users = cursor.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            banned_users = conn.execute('''
+                SELECT user_id, username, reason, banned_at 
+                FROM bans 
+                WHERE unbanned_at IS NULL 
+                ORDER BY banned_at DESC
+            ''').fetchall()
         
         return banned_users
 
     def get_user_info(self, user_id):
         """Получает информацию о пользователе"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
         
         return user
 
+# --- ОТЛОЖЕННАЯ ЗАПИСЬ (WRITE-BEHIND) ---
+# Как часто сбрасывать накопленные изменения в БД (секунды)
+WRITE_BEHIND_FLUSH_INTERVAL = 0.05
+# Сбрасывать досрочно, если накопилось столько изменений
+WRITE_BEHIND_BATCH_SIZE = 200
+# Предел очереди: дальше записи идут напрямую, мимо очереди
+WRITE_BEHIND_MAX_BACKLOG = 10000
+
+class WriteBehindQueue:
+    """Копит профили, дизлайки и сессии и пишет их пачкой в одной транзакции.
+    
+    Словари в памяти обновляются сразу, поэтому бот видит свои изменения,
+    а БД отстает на несколько миллисекунд. Один commit (и один fsync)
+    приходится на всю пачку, а не на каждое событие.
+    """
+    
+    # Вид изменения -> запрос для executemany
+    STATEMENTS = {
+        'user': SQL_SAVE_USER,
+        'dislike': SQL_ADD_DISLIKE,
+        'clear_dislikes': SQL_CLEAR_DISLIKES,
+        'session': SQL_SAVE_SESSION,
+        'drop_session': SQL_DROP_SESSION,
+        'conversation': SQL_SAVE_CONVERSATION,
+        'end_conversation': SQL_END_CONVERSATION,
+    }
+    
+    def __init__(self, database, flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+                 batch_size=WRITE_BEHIND_BATCH_SIZE, max_backlog=WRITE_BEHIND_MAX_BACKLOG):
+        self.db = database
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_backlog = max_backlog
+        
+        self._cond = threading.Condition()
+        # Профили схлопываются: в БД важен только последний снимок
+        self._users = {}
+        # Профили из пачки, которая прямо сейчас пишется в БД
+        self._inflight_users = {}
+        self._pending = []
+        self._closed = False
+        # Сбросы идут строго по одному (из фонового потока или при остановке)
+        self._flush_lock = threading.Lock()
+        
+        # Счетчики
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flushed_items = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        
+        self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+        self._thread.start()
+    
+    @property
+    def depth(self):
+        """Сколько изменений ждут записи"""
+        return len(self._pending) + len(self._users)
+    
+    def is_user_pending(self, user_id):
+        """Есть ли у пользователя профиль, еще не дошедший до БД"""
+        return user_id in self._users or user_id in self._inflight_users
+    
+    def offer(self, kind, params):
+        """Ставит изменение в очередь. False - очередь полна или закрыта"""
+        with self._cond:
+            # Замена профиля, уже стоящего в очереди, ее не растит - берем и в полную
+            replaces_user = kind == 'user' and params[0] in self._users
+            if self._closed or (self.depth >= self.max_backlog and not replaces_user):
+                self.rejected += 1
+                return False
+            
+            if kind == 'user':
+                self._users[params[0]] = params
+            else:
+                self._pending.append((kind, params))
+            self.enqueued += 1
+            
+            if self.depth >= self.batch_size:
+                self._cond.notify()
+        return True
+    
+    def _run(self):
+        """Фоновый поток: сбрасывает очередь по таймеру или по размеру пачки"""
+        while True:
+            with self._cond:
+                if not self._closed and self.depth < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            
+            self.flush()
+            if closed:
+                break
+    
+    def flush(self):
+        """Записывает все накопленное одной транзакцией. Возвращает число записей"""
+        with self._flush_lock:
+            with self._cond:
+                users, self._users = self._users, {}
+                pending, self._pending = self._pending, []
+                self._inflight_users = users
+            
+            count = len(users) + len(pending)
+            if not count:
+                return 0
+            
+            # Подряд идущие изменения одного вида - в один executemany.
+            # Порядок видов сохраняем: очистка дизлайков и новые дизлайки
+            # после нее должны попасть в БД именно в такой последовательности
+            batches = []
+            for kind, params in pending:
+                if batches and batches[-1][0] == kind:
+                    batches[-1][1].append(params)
+                else:
+                    batches.append((kind, [params]))
+            
+            started = time.monotonic()
+            try:
+                with self.db.connection() as conn:
+                    if users:
+                        conn.executemany(self.STATEMENTS['user'], users.values())
+                    for kind, rows in batches:
+                        conn.executemany(self.STATEMENTS[kind], rows)
+            except Exception as e:
+                logger.error(f"Write-behind flush of {count} items failed: {e}")
+                self.failed_flushes += 1
+                # Возвращаем изменения в очередь, более свежие профили не затираем
+                with self._cond:
+                    self._pending = pending + self._pending
+                    for user_id, params in users.items():
+                        self._users.setdefault(user_id, params)
+                return 0
+            finally:
+                with self._cond:
+                    self._inflight_users = {}
+            
+            elapsed_ms = (time.monotonic() - started) * 1000
+            self.flushes += 1
+            self.flushed_items += count
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            return count
+    
+    def close(self):
+        """Останавливает фоновый поток, дописав все, что осталось в очереди"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        logger.info(f"Write-behind queue closed, {self.flushed_items} items written in {self.flushes} flushes")
+    
+    def get_metrics(self):
+        """Счетчики очереди для админки"""
+        return {
+            'depth': self.depth,
+            'enqueued': self.enqueued,
+            'rejected': self.rejected,
+            'flushes': self.flushes,
+            'flushed_items': self.flushed_items,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_ms': self.last_flush_ms,
+            'max_flush_ms': self.max_flush_ms,
+        }
+
+# --- АСИНХРОННЫЙ ДОСТУП К БД ---
+# Число потоков-читателей (плюс один поток-писатель). Вместе не больше DB_POOL_SIZE
+DB_READER_THREADS = DB_POOL_SIZE - 1
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database: запросы выполняются вне event loop.
+    
+    Все записи идут через один поток-писатель (SQLite все равно допускает
+    только одного писателя), чтения - через пул потоков-читателей.
+    """
+    
+    def __init__(self, database, write_behind, reader_threads=DB_READER_THREADS):
+        self.db = database
+        self.write_behind = write_behind
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix="db-reader")
+    
+    async def read(self, func, *args):
+        """Выполняет функцию чтения в потоке-читателе"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(func, *args))
+    
+    async def write(self, func, *args):
+        """Выполняет функцию записи в потоке-писателе"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(func, *args))
+    
+    async def write_through(self, func, *args):
+        """Пишет мимо очереди отложенной записи, сначала дописав ее.
+        
+        Иначе более старое изменение из очереди (профиль, сессия, дизлайк)
+        попадет в БД позже и затрет это.
+        """
+        return await self.write(self._flush_and_call, func, *args)
+    
+    def _flush_and_call(self, func, *args):
+        # flush ждет и пачку, которую фоновый поток пишет прямо сейчас
+        self.write_behind.flush()
+        return func(*args)
+    
+    def shutdown(self):
+        """Дожидается завершения всех запросов и останавливает потоки"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.write_behind.close()
+    
+    # --- Запись ---
+    async def init_db(self):
+        return await self.write(self.db.init_db)
+    
+    async def save_user(self, user_id, profile_data):
+        # Снимок профиля берем сразу: хендлеры продолжают менять его после вызова
+        params = self.db.user_row(user_id, profile_data)
+        if not self.write_behind.offer('user', params):
+            await self.write_through(self.db.save_user, user_id, dict(profile_data))
+    
+    async def like_and_match(self, liker_id, liked_id):
+        """Записывает лайк сразу, дописав очередь. True - это новое совпадение"""
+        # Встречный лайк может еще лежать в очереди отложенной записи
+        return await self.write_through(self.db.like_and_match, liker_id, liked_id)
+    
+    async def claim_outbox(self, limit, lease, shard_count=1, shard_index=0):
+        return await self.write(self.db.claim_outbox, limit, lease, shard_count, shard_index)
+    
+    async def settle_outbox(self, delivered, retries, dead):
+        return await self.write(self.db.settle_outbox, delivered, retries, dead)
+    
+    async def add_dislike(self, disliker_id, disliked_id):
+        if not self.write_behind.offer('dislike', (disliker_id, disliked_id)):
+            await self.write_through(self.db.add_dislike, disliker_id, disliked_id)
+    
+    async def clear_dislikes(self, disliker_id):
+        if not self.write_behind.offer('clear_dislikes', (disliker_id,)):
+            await self.write_through(self.db.clear_dislikes, disliker_id)
+    
+    async def clear_likes(self, liker_id):
+        """Сразу через поток записи: иначе старый лайк в БД даст ложное совпадение"""
+        await self.write(self.db.clear_likes, liker_id)
+    
+    async def clear_matches(self, user_id):
+        """Сразу через поток записи: старая строка не даст паре совпасть заново"""
+        await self.write(self.db.clear_matches, user_id)
+    
+    async def prune_deletions(self):
+        return await self.write(self.db.prune_deletions)
+    
+    async def save_session(self, user_id, data):
+        if not self.write_behind.offer('session', (user_id, data)):
+            await self.write_through(self.db.save_session, user_id, data)
+    
+    async def drop_session(self, user_id):
+        if not self.write_behind.offer('drop_session', (user_id,)):
+            await self.write_through(self.db.drop_session, user_id)
+    
+    async def save_conversation(self, name, key, state):
+        if not self.write_behind.offer('conversation', (name, key, state)):
+            await self.write_through(self.db.save_conversation, name, key, state)
+    
+    async def end_conversation(self, name, key):
+        if not self.write_behind.offer('end_conversation', (name, key)):
+            await self.write_through(self.db.end_conversation, name, key)
+    
+    async def flush_writes(self):
+        """Дописывает очередь отложенной записи в БД прямо сейчас"""
+        return await self.write(self.write_behind.flush)
+    
+    async def set_maintenance_mode(self, enabled, message=None, end_time=None):
+        return await self.write(self.db.set_maintenance_mode, enabled, message, end_time)
+    
+    async def ban_user(self, user_id, username, reason, admin_id):
+        return await self.write(self.db.ban_user, user_id, username, reason, admin_id)
+    
+    async def unban_user(self, user_id):
+        return await self.write(self.db.unban_user, user_id)
+    
+    # --- Чтение ---
+    async def load_all_data(self):
+        # Читаем в потоке, а в словари вливаем уже в event loop,
+        # чтобы хендлеры не увидели их посреди изменения
+        self.db.merge_loaded_data(await self.read(self.db.fetch_all_data), self.write_behind.is_user_pending)
+        logger.info(f"Loaded from DB: {len(user_profiles)} users, {len(user_likes)} like relations")
+    
+    async def sync_changes(self):
+        """Подтягивает в память только то, что изменилось в БД.
+        
+        Возвращает прочитанные строки (users, likes, matches, dislikes, deletions)
+        или None, если изменений не было.
+        """
+        changes = await self.read(self._flush_and_fetch_changes)
+        if changes is None:
+            return None
+        
+        self.db.merge_loaded_data(changes, self.write_behind.is_user_pending)
+        users, likes, matches, dislikes, deletions = changes
+        logger.debug(f"Synced from DB: {len(users)} users, {len(likes)} likes, "
+                     f"{len(matches)} matches, dislikes of {len(dislikes)} users, {len(deletions)} deletions")
+        return changes
+    
+    def _flush_and_fetch_changes(self):
+        # Сначала дописываем свою очередь, чтобы не прочитать из БД
+        # устаревшие версии только что измененных профилей
+        self.write_behind.flush()
+        return self.db.fetch_changes()
+    
+    async def get_maintenance_status(self):
+        return await self.read(self.db.get_maintenance_status)
+    
+    async def get_banned_users(self):
+        return await self.read(self.db.get_banned_users)
+    
+    async def get_user_info(self, user_id):
+        return await self.read(self.db.get_user_info, user_id)
+    
+    async def get_session(self, user_id):
+        return await self.read(self.db.get_session, user_id)
+    
+    async def get_conversations(self, name):
+        return await self.read(self.db.get_conversations, name)
+    
+    async def next_outbox_due(self):
+        return await self.read(self.db.next_outbox_due)
+    
+    async def outbox_counts(self):
+        return await self.read(self.db.outbox_counts)
+
 # Инициализация базы данных
 db = Database(DB_FILE)
+write_behind = WriteBehindQueue(db)
+adb = AsyncDatabase(db, write_behind)
+
+# --- РЕЕСТР БАНОВ ---
+class BanRegistry:
+    """Активные баны в памяти: проверка бана не ходит в БД.
+    
+    Загружается один раз при старте, ban/unban обновляют и память, и БД.
+    """
+    
+    def __init__(self, async_db):
+        self.adb = async_db
+        # user_id -> (username, reason, banned_at)
+        self._bans = {}
+    
+    def load(self, database):
+        """Загружает активные баны из БД (синхронно, при старте)"""
+        self._bans = {
+            user_id: (username, reason, banned_at)
+            for user_id, username, reason, banned_at in database.get_banned_users()
+        }
+        logger.info(f"Loaded {len(self._bans)} active bans")
+    
+    async def reload(self):
+        """Перечитывает активные баны из БД (их могли изменить другие воркеры).
+        
+        Возвращает id пользователей, у которых бан появился или снят.
+        """
+        bans = {
+            user_id: (username, reason, banned_at)
+            for user_id, username, reason, banned_at in await self.adb.get_banned_users()
+        }
+        changed = bans.keys() ^ self._bans.keys()
+        self._bans = bans
+        return changed
+    
+    def __len__(self):
+        return len(self._bans)
+    
+    def is_banned(self, user_id):
+        return user_id in self._bans
+    
+    def get_reason(self, user_id):
+        """Причина бана или None, если пользователь не забанен"""
+        ban = self._bans.get(user_id)
+        return ban[1] if ban else None
+    
+    def list_bans(self):
+        """Активные баны в формате get_banned_users: (user_id, username, reason, banned_at)"""
+        bans = [(user_id, *ban) for user_id, ban in self._bans.items()]
+        bans.sort(key=lambda ban: ban[3] or '', reverse=True)
+        return bans
+    
+    async def ban(self, user_id, username, reason, admin_id):
+        """Банит пользователя в памяти и в БД"""
+        # Формат и часовой пояс как у CURRENT_TIMESTAMP в SQLite
+        banned_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        self._bans[user_id] = (username, reason, banned_at)
+        await self.adb.ban_user(user_id, username, reason, admin_id)
+    
+    async def unban(self, user_id):
+        """Разбанивает пользователя в памяти и в БД"""
+        self._bans.pop(user_id, None)
+        await self.adb.unban_user(user_id)
+
+ban_registry = BanRegistry(adb)
+
+# --- СОСТОЯНИЕ ТЕХОБСЛУЖИВАНИЯ ---
+# Формат maintenance_end в bot_settings (локальное время сервера)
+MAINTENANCE_END_FORMAT = '%Y-%m-%d %H:%M'
+
+class MaintenanceState:
+    """Режим техобслуживания в памяти: хендлеры не ходят за ним в БД.
+    
+    Обновляется через set(), которая пишет и в БД. Если задан
+    maintenance_end, режим считается выключенным после этого времени.
+    """
+    
+    def __init__(self, async_db):
+        self.adb = async_db
+        self.enabled = False
+        self.message = None
+        self.end = None
+        self._end_at = None
+        # Окно, об окончании которого уже написали в лог: reload() его не сбрасывает
+        self._logged_end = None
+    
+    def load(self, database):
+        """Загружает состояние из БД (синхронно, при старте)"""
+        status = database.get_maintenance_status()
+        self._apply(status['maintenance_mode'], status['maintenance_message'], status['maintenance_end'])
+    
+    async def reload(self):
+        """Перечитывает состояние из БД (его мог изменить другой воркер)"""
+        status = await self.adb.get_maintenance_status()
+        self._apply(status['maintenance_mode'], status['maintenance_message'], status['maintenance_end'])
+    
+    def _apply(self, enabled, message, end):
+        self.enabled = enabled
+        self.message = message
+        self.end = end
+        self._end_at = None
+        if end:
+            try:
+                self._end_at = datetime.strptime(end, MAINTENANCE_END_FORMAT)
+            except ValueError:
+                logger.warning(f"Invalid maintenance_end value: {end}")
+    
+    def is_active(self):
+        """Включено ли техобслуживание прямо сейчас"""
+        if not self.enabled:
+            return False
+        if self._end_at and datetime.now() >= self._end_at:
+            # Время вышло. Состояние не меняем: reload() все равно вернул бы
+            # enabled из БД, а выключенным режим по-прежнему считается по end
+            if self._logged_end != self.end:
+                self._logged_end = self.end
+                logger.info("Scheduled maintenance window is over")
+            return False
+        return True
+    
+    async def set(self, enabled, message=None, end_time=None):
+        """Меняет режим в памяти и в БД"""
+        self._apply(enabled, message, end_time)
+        await self.adb.set_maintenance_mode(enabled, message, end_time)
 
-# --- ФУНКЦИИ ДЛЯ СОХРАНЕНИЯ ДАННЫХ ---
-def save_data():
-    """Сохраняет все данные (резервное копирование)"""
-    data = {
-        'user_profiles': user_profiles,
-        'user_likes': user_likes,
-        'user_dislikes': user_dislikes,
-        'matched_users': matched_users
-    }
+maintenance_state = MaintenanceState(adb)
+
+# --- РЕЗЕРВНОЕ КОПИРОВАНИЕ ---
+# Куда складывать снимки БД
+BACKUP_DIR = "backups"
+# Как часто делать снимок (секунды)
+BACKUP_INTERVAL = 6 * 60 * 60
+# Сколько последних снимков хранить
+BACKUP_KEEP = 5
+# Сколько страниц копировать за один шаг и пауза между шагами:
+# между шагами БД свободна, и писатель не ждет конца всего копирования
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+
+class BackupAborted(Exception):
+    """Копирование прервано остановкой бота"""
+
+class BackupManager:
+    """Делает снимки БД через sqlite3 backup API в фоновом потоке.
+    
+    Копирование идет порциями страниц, поэтому не блокирует ни event loop,
+    ни запись в БД, а при остановке бота прерывается, а не задерживает ее.
+    """
+    
+    def __init__(self, db_file, backup_dir=BACKUP_DIR, interval=BACKUP_INTERVAL, keep=BACKUP_KEEP):
+        self.db_file = db_file
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.keep = keep
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        
+        # Метрики
+        self.backups_done = 0
+        self.failures = 0
+        self.last_duration = None
+        self.last_size = None
+        self.last_path = None
+        self.last_finished_at = None
+    
+    def start(self):
+        """Запускает фоновый поток резервного копирования"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="db-backup", daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout=1.0):
+        """Останавливает поток; незаконченное копирование прерывается"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+    
+    def request_backup(self):
+        """Просит сделать снимок прямо сейчас, не дожидаясь расписания"""
+        self._wakeup.set()
+    
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.run_backup()
+            except BackupAborted:
+                logger.info("Backup aborted on shutdown")
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Backup failed: {e}")
+    
+    def _progress(self, status, remaining, total):
+        if self._stop.is_set():
+            raise BackupAborted()
+    
+    def run_backup(self):
+        """Делает один снимок БД и удаляет лишние старые"""
+        started = time.monotonic()
+        os.makedirs(self.backup_dir, exist_ok=True)
+        name = f"{os.path.splitext(os.path.basename(self.db_file))[0]}-{time.strftime('%Y%m%d-%H%M%S')}.db"
+        path = os.path.join(self.backup_dir, name)
+        tmp_path = path + ".tmp"
+        
+        source = sqlite3.connect(self.db_file, timeout=DB_BUSY_TIMEOUT)
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=self._progress, sleep=BACKUP_STEP_SLEEP)
+        except BaseException:
+            target.close()
+            os.remove(tmp_path)
+            raise
+        finally:
+            source.close()
+        target.close()
+        # Снимок появляется под своим именем только целиком
+        os.replace(tmp_path, path)
+        
+        self.backups_done += 1
+        self.last_duration = time.monotonic() - started
+        self.last_size = os.path.getsize(path)
+        self.last_path = path
+        self.last_finished_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        logger.info(f"Backup {path} done in {self.last_duration:.2f}s ({self.last_size} bytes)")
+        
+        self._rotate()
+    
+    def _rotate(self):
+        """Оставляет только self.keep последних снимков"""
+        prefix = os.path.splitext(os.path.basename(self.db_file))[0] + "-"
+        snapshots = sorted(
+            name for name in os.listdir(self.backup_dir)
+            if name.startswith(prefix) and name.endswith(".db")
+        )
+        for name in snapshots[:-self.keep]:
+            try:
+                os.remove(os.path.join(self.backup_dir, name))
+            except OSError as e:
+                logger.warning(f"Could not remove old backup {name}: {e}")
+    
+    def get_metrics(self):
+        """Метрики для админки"""
+        return {
+            'backups_done': self.backups_done,
+            'failures': self.failures,
+            'last_duration': self.last_duration,
+            'last_size': self.last_size,
+            'last_finished_at': self.last_finished_at,
+        }
+
+backup_manager = BackupManager(DB_FILE)
+
+# --- СНИМОК ИНДЕКСОВ ДЛЯ БЫСТРОГО СТАРТА ---
+INDEX_SNAPSHOT_FILE = "bot_index.snap"
+INDEX_SNAPSHOT_MAGIC = b'TGIX'
+# Увеличивать при любом изменении формата: снимок другой версии игнорируется
+INDEX_SNAPSHOT_VERSION = 3
+# Как часто писать снимок (секунды)
+INDEX_SNAPSHOT_INTERVAL = 30 * 60
+# Пауза после каждой пачки строк: поток снимка не держит GIL подолгу
+INDEX_SNAPSHOT_STEP_SLEEP = 0.001
+
+# magic, версия, водяные знаки лайков/совпадений/дизлайков
+# и число лайков/совпадений/дизлайков до знаков
+_SNAPSHOT_HEADER = struct.Struct('<4sIqqqqqq')
+# Число ключей и число id в списке смежности
+_SNAPSHOT_ADJACENCY = struct.Struct('<qq')
+_SNAPSHOT_COUNT = struct.Struct('<q')
+_SNAPSHOT_LENGTH = struct.Struct('<I')
+# Запись анкеты: user_id и длина полей
+_SNAPSHOT_RECORD = struct.Struct('<qI')
+_SNAPSHOT_INT = struct.Struct('<q')
+# Тег перед каждым полем анкеты
+_SNAPSHOT_TAG_NONE, _SNAPSHOT_TAG_INT, _SNAPSHOT_TAG_STR = 0, 1, 2
+
+class SnapshotError(Exception):
+    """Файл снимка поврежден или другой версии"""
+
+class SnapshotAborted(Exception):
+    """Запись снимка прервана остановкой бота"""
+
+def _ids_to_bytes(ids):
+    """array('q') -> байты little-endian"""
+    if sys.byteorder != 'little':
+        ids = array('q', ids)
+        ids.byteswap()
+    return ids.tobytes()
+
+def _ids_from_bytes(view, offset, count):
+    """Читает count id одним куском, без разбора по строкам"""
+    end = offset + count * 8
+    if end > len(view):
+        raise SnapshotError("truncated id array")
+    ids = array('q')
+    ids.frombytes(view[offset:end])
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    return ids, end
+
+def _pack_str(value):
+    data = value.encode('utf-8')
+    return _SNAPSHOT_LENGTH.pack(len(data)) + data
+
+def _unpack_str(view, offset):
+    (length,) = _SNAPSHOT_LENGTH.unpack_from(view, offset)
+    offset += _SNAPSHOT_LENGTH.size
+    return str(view[offset:offset + length], 'utf-8'), offset + length
+
+def _collect_adjacency(cursor, step):
+    """Строки (ключ, id), упорядоченные по ключу -> три плоских массива: ключи, длины, все id подряд.
+    
+    step() вызывается после каждой пачки строк.
+    """
+    keys, counts, targets = array('q'), array('q'), array('q')
+    current = None
+    while True:
+        rows = cursor.fetchmany(DB_FETCH_BATCH)
+        if not rows:
+            break
+        for key, target in rows:
+            if key != current:
+                current = key
+                keys.append(key)
+                counts.append(0)
+            counts[-1] += 1
+            targets.append(target)
+        step()
+    return keys, counts, targets
+
+def _write_adjacency(f, keys, counts, targets):
+    """Пишет массивы из _collect_adjacency"""
+    f.write(_SNAPSHOT_ADJACENCY.pack(len(keys), len(targets)))
+    f.write(_ids_to_bytes(keys))
+    f.write(_ids_to_bytes(counts))
+    f.write(_ids_to_bytes(targets))
+
+def _read_adjacency(view, offset, make_set):
+    """Обратное к _write_adjacency: make_set получает срез array('q') с id одного ключа"""
+    n_keys, n_targets = _SNAPSHOT_ADJACENCY.unpack_from(view, offset)
+    offset += _SNAPSHOT_ADJACENCY.size
+    keys, offset = _ids_from_bytes(view, offset, n_keys)
+    counts, offset = _ids_from_bytes(view, offset, n_keys)
+    targets, offset = _ids_from_bytes(view, offset, n_targets)
+    
+    adjacency = {}
+    position = 0
+    for key, count in zip(keys, counts):
+        adjacency[key] = make_set(targets[position:position + count])
+        position += count
+    if position != n_targets:
+        raise SnapshotError("adjacency counts do not match ids")
+    return adjacency, offset
+
+def _pack_profile(user_id, profile):
+    """Запись анкеты: поля в порядке PROFILE_FIELDS, каждое с тегом типа"""
+    parts = []
+    for key in PROFILE_FIELDS:
+        value = profile.get(key)
+        if value is None:
+            parts.append(bytes((_SNAPSHOT_TAG_NONE,)))
+        elif isinstance(value, int):
+            parts.append(bytes((_SNAPSHOT_TAG_INT,)) + _SNAPSHOT_INT.pack(value))
+        elif isinstance(value, str):
+            parts.append(bytes((_SNAPSHOT_TAG_STR,)) + _pack_str(value))
+        else:
+            raise SnapshotError(f"unsupported value for {key}: {type(value).__name__}")
+    payload = b''.join(parts)
+    return _SNAPSHOT_RECORD.pack(user_id, len(payload)) + payload
+
+def _read_profiles(view, offset):
+    (count,) = _SNAPSHOT_COUNT.unpack_from(view, offset)
+    offset += _SNAPSHOT_COUNT.size
+    profiles = {}
+    for _ in range(count):
+        user_id, length = _SNAPSHOT_RECORD.unpack_from(view, offset)
+        offset += _SNAPSHOT_RECORD.size
+        end = offset + length
+        row = [user_id]
+        for _key in PROFILE_FIELDS:
+            tag = view[offset]
+            offset += 1
+            if tag == _SNAPSHOT_TAG_NONE:
+                row.append(None)
+            elif tag == _SNAPSHOT_TAG_INT:
+                row.append(_SNAPSHOT_INT.unpack_from(view, offset)[0])
+                offset += _SNAPSHOT_INT.size
+            elif tag == _SNAPSHOT_TAG_STR:
+                value, offset = _unpack_str(view, offset)
+                row.append(value)
+            else:
+                raise SnapshotError(f"unknown field tag {tag}")
+        if offset != end:
+            raise SnapshotError(f"bad record length for user {user_id}")
+        profiles[user_id] = Profile.from_row(row)
+    return profiles, offset
+
+def save_index_snapshot(db_file, path=INDEX_SNAPSHOT_FILE, step=lambda: None):
+    """Пишет снимок индексов прямо из БД вместе с ее водяными знаками.
+    
+    Все читается одной транзакцией отдельного соединения: снимок согласован
+    с базой и не трогает словари в памяти, поэтому его можно писать из
+    фонового потока. step() вызывается после каждой пачки строк.
+    """
+    started = time.monotonic()
+    tmp_path = path + ".tmp"
+    conn = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT, isolation_level=None)
     try:
-        with open("backup_data.pkl", 'wb') as f:
-            pickle.dump(data, f)
-        logger.info("Backup data saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving backup data: {e}")
+        # В WAL читающая транзакция видит базу на момент первого SELECT
+        conn.execute('BEGIN')
+        marks = Database._current_watermarks(conn)
+        likes_mark, matches_mark, dislikes_mark, users_mark = marks
+        counts = Database.count_up_to_marks(conn, marks)
+        
+        likes = _collect_adjacency(conn.execute(
+            'SELECT liker_id, liked_id FROM likes WHERE id <= ? ORDER BY liker_id', (likes_mark,)
+        ), step)
+        liked_by = _collect_adjacency(conn.execute(
+            'SELECT liked_id, liker_id FROM likes WHERE id <= ? ORDER BY liked_id', (likes_mark,)
+        ), step)
+        # Совпадение хранится одной строкой, а в памяти - с обеих сторон
+        matches = _collect_adjacency(conn.execute('''
+            SELECT user1_id, user2_id FROM matches WHERE id <= ?
+            UNION ALL
+            SELECT user2_id, user1_id FROM matches WHERE id <= ?
+            ORDER BY 1
+        ''', (matches_mark, matches_mark)), step)
+        # IdSet.from_sorted при загрузке ждет id по возрастанию
+        dislikes = _collect_adjacency(conn.execute(
+            'SELECT disliker_id, disliked_id FROM dislikes WHERE id <= ? ORDER BY disliker_id, disliked_id',
+            (dislikes_mark,)
+        ), step)
+        
+        users_count = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        with open(tmp_path, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(INDEX_SNAPSHOT_MAGIC, INDEX_SNAPSHOT_VERSION,
+                                          likes_mark, matches_mark, dislikes_mark, *counts))
+            f.write(_pack_str(users_mark))
+            for adjacency in (likes, liked_by, matches, dislikes):
+                _write_adjacency(f, *adjacency)
+            f.write(_SNAPSHOT_COUNT.pack(users_count))
+            cursor = conn.execute('SELECT * FROM users')
+            while True:
+                rows = cursor.fetchmany(DB_FETCH_BATCH)
+                if not rows:
+                    break
+                f.write(b''.join(_pack_profile(row[0], dict(zip(PROFILE_FIELDS, row[1:]))) for row in rows))
+                step()
+        # Снимок появляется под своим именем только целиком
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        conn.close()
+    
+    logger.info(f"Index snapshot written in {time.monotonic() - started:.2f}s: "
+                f"{users_count} users, {os.path.getsize(path)} bytes")
+
+def load_index_snapshot(database, path=INDEX_SNAPSHOT_FILE):
+    """Поднимает словари из снимка и дочитывает из БД строки новее него.
+    
+    Возвращает False, если снимка нет или он не подходит - тогда данные
+    нужно загрузить из БД целиком.
+    """
+    global user_profiles, user_likes, user_liked_by, matched_users, user_dislikes
+    started = time.monotonic()
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                magic, version, likes_mark, matches_mark, dislikes_mark, *counts = \
+                    _SNAPSHOT_HEADER.unpack_from(view, 0)
+                if magic != INDEX_SNAPSHOT_MAGIC or version != INDEX_SNAPSHOT_VERSION:
+                    raise SnapshotError(f"unsupported snapshot version {version}")
+                users_mark, offset = _unpack_str(view, _SNAPSHOT_HEADER.size)
+                likes, offset = _read_adjacency(view, offset, set)
+                liked_by, offset = _read_adjacency(view, offset, set)
+                matches, offset = _read_adjacency(view, offset, set)
+                dislikes, offset = _read_adjacency(view, offset, IdSet.from_sorted)
+                profiles, offset = _read_profiles(view, offset)
+            finally:
+                view.release()
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, struct.error, SnapshotError) as e:
+        logger.warning(f"Index snapshot ignored: {e}")
+        return False
+    
+    marks = (likes_mark, matches_mark, dislikes_mark, users_mark)
+    if not database.resume_from_snapshot(marks, counts):
+        logger.warning("Index snapshot does not match the database, loading from DB")
+        return False
+    
+    user_profiles = profiles
+    user_likes = likes
+    user_liked_by = liked_by
+    matched_users = matches
+    user_dislikes = dislikes
+    bot_stats.rebuild(user_profiles, user_likes, matched_users)
+    
+    # Дочитываем то, что записали после снимка
+    changes = database.fetch_changes()
+    if changes is not None:
+        database.merge_loaded_data(changes)
+        users, new_likes, new_matches, new_dislikes, deletions = changes
+        replayed = (f"{len(users)} users, {len(new_likes)} likes, {len(new_matches)} matches, "
+                    f"{len(deletions)} deletions")
+    else:
+        replayed = "nothing"
+    logger.info(f"Loaded from snapshot in {time.monotonic() - started:.2f}s: {len(user_profiles)} users, "
+                f"{len(user_likes)} like relations; replayed {replayed}")
+    return True
+
+class IndexSnapshotManager:
+    """Пишет снимок индексов по расписанию в фоновом потоке (рядом с BackupManager).
+    
+    Снимок строится из БД, а не из памяти, поэтому остановка бота
+    его не ждет: незаконченный снимок прерывается, старый остается.
+    """
+    
+    def __init__(self, db_file, path=INDEX_SNAPSHOT_FILE, interval=INDEX_SNAPSHOT_INTERVAL):
+        self.db_file = db_file
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        
+        # Метрики
+        self.snapshots_done = 0
+        self.failures = 0
+    
+    def start(self):
+        """Запускает фоновый поток снимков"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="index-snapshot", daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout=1.0):
+        """Останавливает поток; незаконченный снимок прерывается"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+    
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+            try:
+                save_index_snapshot(self.db_file, self.path, step=self._step)
+                self.snapshots_done += 1
+            except SnapshotAborted:
+                logger.info("Index snapshot aborted on shutdown")
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Index snapshot failed: {e}")
+    
+    def _step(self):
+        if self._stop.is_set():
+            raise SnapshotAborted()
+        time.sleep(INDEX_SNAPSHOT_STEP_SLEEP)
 
+index_snapshot_manager = IndexSnapshotManager(DB_FILE)
+
+# --- ФУНКЦИИ ДЛЯ СОХРАНЕНИЯ ДАННЫХ ---
 def load_data():
-    """Загружает данные из базы"""
-    db.load_all_data()
+    """Загружает данные: из снимка индексов с дочиткой новых строк, иначе целиком из базы"""
+    if not load_index_snapshot(db):
+        db.load_all_data()
+    ban_registry.load(db)
+    maintenance_state.load(db)
+    rebuild_candidate_index()
+    swipe_decks.invalidate_all()
     logger.info("Data loaded from database")
 
+async def sync_data():
+    """Подтягивает изменения из базы и обновляет индексы.
+    
+    Обновления обрабатываются параллельно: одновременные вызовы не читают
+    базу каждый сам, а ждут одну и ту же синхронизацию.
+    """
+    global _sync_in_flight
+    if _sync_in_flight is None or _sync_in_flight.done():
+        _sync_in_flight = asyncio.ensure_future(_sync_changes())
+    # shield: отмена одного ожидающего не отменяет синхронизацию для остальных
+    await asyncio.shield(_sync_in_flight)
+
+_sync_in_flight = None
+
+async def _sync_changes():
+    changes = await adb.sync_changes()
+    if changes is None:
+        return
+    users, likes, matches, dislikes, deletions = changes
+    for user in users:
+        refresh_candidate(user[0])
+    # После /clear или /reset в другом процессе пользователь снова видит
+    # оцененные анкеты - колоду собираем заново
+    for kind, user_id, _other_id in deletions:
+        if kind != 'match':
+            swipe_decks.invalidate(user_id)
+    
+    # Баны и техобслуживание в памяти меняет только свой процесс - у воркеров
+    # их надо перечитывать, когда базу изменил кто-то другой
+    if SHARD_COUNT > 1:
+        changed_bans = await ban_registry.reload()
+        for user_id in changed_bans:
+            refresh_candidate(user_id)
+        if changed_bans:
+            swipe_decks.invalidate_all()
+        await maintenance_state.reload()
+
+async def save_profile(user_id):
+    """Сохраняет профиль в БД и обновляет флаг заполненности, статистику и индексы"""
+    profile = user_profiles[user_id]
+    # Те же значения БД проставит сама (CURRENT_TIMESTAMP в UTC)
+    now = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    if not profile.get('created_at'):
+        profile['created_at'] = now
+    profile['last_active'] = now
+    profile.update_completeness()
+    bot_stats.update_profile(user_id, profile)
+    refresh_candidate(user_id)
+    swipe_decks.invalidate(user_id)
+    await adb.save_user(user_id, profile)
+
+def remember_like(liker_id, liked_id):
+    """Добавляет лайк в память. Возвращает False, если он уже был"""
+    liked = user_likes.get(liker_id)
+    if liked is None:
+        liked = user_likes[liker_id] = set()
+    elif liked_id in liked:
+        return False
+    liked.add(liked_id)
+    likers = user_liked_by.get(liked_id)
+    if likers is None:
+        likers = user_liked_by[liked_id] = set()
+    likers.add(liker_id)
+    bot_stats.total_likes += 1
+    return True
+
+def remember_match(user1_id, user2_id):
+    """Добавляет совпадение в память с обеих сторон"""
+    for user_id, other_id in ((user1_id, user2_id), (user2_id, user1_id)):
+        matched = matched_users.get(user_id)
+        if matched is None:
+            matched = matched_users[user_id] = set()
+        if other_id not in matched:
+            matched.add(other_id)
+            bot_stats.match_links += 1
+
+async def record_like(liker_id, liked_id, context):
+    """Лайк в память и БД. Возвращает, было ли совпадение.
+    
+    Уведомления другой стороне уже лежат в outbox - ответ лайкнувшему их не ждет.
+    Если запись в БД не удалась, лайк убирается из памяти и ошибка пробрасывается дальше.
+    """
+    added = remember_like(liker_id, liked_id)
+    try:
+        new_match = await adb.like_and_match(liker_id, liked_id)
+    except Exception:
+        if added:
+            forget_like(liker_id, liked_id)
+        raise
+    if new_match:
+        remember_match(liker_id, liked_id)
+    outbox.wake()
+    return new_match
+
+def forget_like(liker_id, liked_id):
+    """Убирает один лайк из памяти (удален в БД, возможно, другим процессом)"""
+    liked = user_likes.get(liker_id)
+    if liked and liked_id in liked:
+        liked.discard(liked_id)
+        likers = user_liked_by.get(liked_id)
+        if likers:
+            likers.discard(liker_id)
+        bot_stats.total_likes -= 1
+
+def forget_match(user1_id, user2_id):
+    """Убирает одно совпадение из памяти с обеих сторон"""
+    for user_id, other_id in ((user1_id, user2_id), (user2_id, user1_id)):
+        matched = matched_users.get(user_id)
+        if matched and other_id in matched:
+            matched.discard(other_id)
+            bot_stats.match_links -= 1
+
+def forget_likes(user_id):
+    """Очищает лайки пользователя в памяти"""
+    liked = user_likes.get(user_id)
+    if liked:
+        bot_stats.total_likes -= len(liked)
+        for liked_id in liked:
+            user_liked_by[liked_id].discard(user_id)
+        user_likes[user_id] = set()
+
+def forget_matches(user_id):
+    """Очищает совпадения пользователя в памяти с обеих сторон - как и в БД"""
+    matched = matched_users.get(user_id)
+    if matched:
+        bot_stats.match_links -= len(matched)
+        for other_id in matched:
+            other = matched_users.get(other_id)
+            if other and user_id in other:
+                other.discard(user_id)
+                bot_stats.match_links -= 1
+        matched_users[user_id] = set()
+
 def setup_data_persistence():
-    """Настраивает автосохранение при выходе"""
+    """Настраивает корректное завершение при выходе"""
     def save_on_exit():
         maintenance_notice()
-        save_data()  # Резервное копирование
-        logger.info("Backup saved on exit")
+        # Ни копирование БД, ни снимок индексов не ждем: все данные и так в SQLite
+        backup_manager.stop()
+        index_snapshot_manager.stop()
+        # Дописываем очередь отложенной записи и останавливаем потоки БД
+        adb.shutdown()
+        db.close()
+        logger.info("Data flushed on exit")
     
     def save_on_signal(signum, frame):
-        maintenance_notice()
-        save_data()  # Резервное копирование
-        logger.info(f"Backup saved on signal {signum}")
-        exit(0)
+        logger.info(f"Stopping on signal {signum}")
+        exit(0)  # Остальное сделает save_on_exit через atexit
     
     atexit.register(save_on_exit)
     signal.signal(signal.SIGINT, save_on_signal)
@@ -401,11 +2176,11 @@ def maintenance_notice():
     print("🕐 Время остановки:", time.strftime("%Y-%m-%d %H:%M:%S"))
     print("📈 Статистика перед остановкой:")
     print(f"   👥 Пользователей: {len(user_profiles)}")
-    print(f"   ✅ Заполненных анкет: {len([uid for uid in user_profiles if is_profile_complete(uid)])}")
-    print(f"   ❤️  Всего лайков: {sum(len(likes) for likes in user_likes.values())}")
-    print(f"   💞 Совпадений: {sum(len(matches) for matches in matched_users.values()) // 2}")
+    print(f"   ✅ Заполненных анкет: {bot_stats.complete_profiles}")
+    print(f"   ❤️  Всего лайков: {bot_stats.total_likes}")
+    print(f"   💞 Совпадений: {bot_stats.total_matches}")
     print(f"   📊 Активных сессий: {len(user_profiles)}")
-    print("💾 Сохранение данных...")
+    print("💾 Запись данных в БД...")
     print("="*60 + "\n")
 
 def startup_notice():
@@ -415,40 +2190,376 @@ def startup_notice():
     print("🕐 Время запуска:", time.strftime("%Y-%m-%d %H:%M:%S"))
     print("📥 Загружено данных:")
     print(f"   👥 Пользователей: {len(user_profiles)}")
-    print(f"   ❤️  Лайков: {sum(len(likes) for likes in user_likes.values())}")
-    print(f"   💞 Совпадений: {sum(len(matches) for matches in matched_users.values()) // 2}")
+    print(f"   ❤️  Лайков: {bot_stats.total_likes}")
+    print(f"   💞 Совпадений: {bot_stats.total_matches}")
     
     # Проверяем режим техобслуживания
-    maintenance_status = db.get_maintenance_status()
-    if maintenance_status['maintenance_mode']:
+    if maintenance_state.is_active():
         print("   ⚠️  Бот в режиме техобслуживания")
     
     # Проверяем баны
-    banned_users = db.get_banned_users()
-    print(f"   🚫 Забанено пользователей: {len(banned_users)}")
+    print(f"   🚫 Забанено пользователей: {len(ban_registry)}")
     
     print("="*50 + "\n")
 
+# --- ОТПРАВКА СООБЩЕНИЙ ---
+# Общий лимит Telegram на исходящие сообщения бота (в секунду) и допустимый всплеск
+DISPATCH_GLOBAL_RATE = 25
+DISPATCH_GLOBAL_BURST = 30
+# Лимит на один чат: около сообщения в секунду, короткий всплеск допустим
+DISPATCH_CHAT_RATE = 1
+DISPATCH_CHAT_BURST = 3
+# Приоритеты: ответы на действия пользователя идут раньше уведомлений
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFICATION = 1
+# Сколько заданий очереди просматривать за раз в поисках готового к отправке
+DISPATCH_SCAN_LIMIT = 256
+# Сколько раз повторять отправку после RetryAfter
+DISPATCH_MAX_RETRIES = 3
+# Сколько при остановке ждать отправки очереди и начатых отправок (секунды)
+DISPATCH_STOP_TIMEOUT = 5
+# Лимит длины текста сообщения Telegram - склеенные сообщения не должны его превышать
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def retry_after_seconds(error):
+    """Пауза из RetryAfter в секундах (в разных версиях PTB - число или timedelta)"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+    
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.paused_until = 0.0
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now):
+        """Через сколько секунд можно будет взять токен (0 - уже можно)"""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self):
+        self.tokens -= 1
+    
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+class _OutgoingMessage:
+    __slots__ = ('method', 'priority', 'chat_id', 'kwargs', 'futures', 'retries')
+    
+    def __init__(self, method, priority, chat_id, kwargs, future):
+        self.method = method
+        self.priority = priority
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.futures = [future] if future is not None else []
+        self.retries = 0
+
+class MessageDispatcher:
+    """Единая точка отправки всех исходящих сообщений бота.
+    
+    Общее ведро токенов держит лимит бота, ведра по чатам - лимит на чат,
+    очереди по приоритетам пропускают ответы пользователю вперед уведомлений.
+    Подряд идущие простые тексты в один чат склеиваются в одно сообщение.
+    На RetryAfter чат ставится на паузу, а сообщение - обратно в начало очереди.
+    Сообщения в один чат уходят строго по порядку, по одному за раз.
+    """
+    
+    def __init__(self):
+        self._bot = None
+        self._lanes = (deque(), deque())  # по PRIORITY_*
+        # Лимит бота делится поровну между воркерами: каждый держит свою долю
+        self._global = TokenBucket(DISPATCH_GLOBAL_RATE / SHARD_COUNT,
+                                   max(1, DISPATCH_GLOBAL_BURST // SHARD_COUNT), time.monotonic())
+        self._chats = {}  # chat_id -> TokenBucket
+        self._busy_chats = set()
+        self._wakeup = None
+        self._task = None
+        # Начатые отправки: ссылка держит задачу до конца (иначе ее может собрать GC)
+        self._deliveries = set()
+        
+        # Метрики
+        self.sent = 0
+        self.coalesced = 0
+        self.retry_after = 0
+        self.failed = 0
+    
+    def bind(self, bot):
+        """Задает бота, через которого идет отправка"""
+        self._bot = bot
+    
+    @property
+    def depth(self):
+        return len(self._lanes[PRIORITY_INTERACTIVE]) + len(self._lanes[PRIORITY_NOTIFICATION])
+    
+    async def send(self, method, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Ставит вызов bot.<method>(**kwargs) в очередь и ждет его результата"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(method, priority, kwargs, future)
+        return await future
+    
+    def post(self, method, priority=PRIORITY_NOTIFICATION, **kwargs):
+        """Ставит вызов в очередь, не дожидаясь отправки; ошибки только логируются"""
+        self._enqueue(method, priority, kwargs, None)
+    
+    def _enqueue(self, method, priority, kwargs, future):
+        chat_id = kwargs.get('chat_id')
+        lane = self._lanes[priority]
+        if lane and self._coalesce(lane[-1], method, chat_id, kwargs, future):
+            self.coalesced += 1
+        else:
+            lane.append(_OutgoingMessage(method, priority, chat_id, kwargs, future))
+        self._ensure_running()
+        self._wakeup.set()
+    
+    @staticmethod
+    def _coalesce(last, method, chat_id, kwargs, future):
+        """Дописывает текст к последнему еще не отправленному сообщению в тот же чат"""
+        if (method != 'send_message' or last.method != 'send_message' or last.chat_id != chat_id
+                or set(last.kwargs) != {'chat_id', 'text'}
+                or not set(kwargs) <= {'chat_id', 'text', 'reply_markup'}):
+            return False
+        text = f"{last.kwargs['text']}\n\n{kwargs['text']}"
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            return False
+        last.kwargs = dict(kwargs, text=text)
+        if future is not None:
+            last.futures.append(future)
+        return True
+    
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Не даем словарю расти бесконечно: полные ведра ничего не ограничивают
+            if len(self._chats) >= 10000:
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(DISPATCH_CHAT_RATE, DISPATCH_CHAT_BURST, now)
+        return bucket
+    
+    def _next_ready(self):
+        """Следующее сообщение, которое можно отправить сейчас, или (None, сколько ждать)"""
+        now = time.monotonic()
+        delay = self._global.wait_time(now)
+        if delay > 0:
+            return None, delay
+        
+        delay = None
+        for lane in self._lanes:
+            blocked = set()
+            for index, message in enumerate(lane):
+                if index >= DISPATCH_SCAN_LIMIT:
+                    break
+                chat_id = message.chat_id
+                # Более раннее сообщение в этот чат еще ждет - порядок не нарушаем
+                if chat_id in blocked or chat_id in self._busy_chats:
+                    blocked.add(chat_id)
+                    continue
+                wait = self._chat_bucket(chat_id, now).wait_time(now) if chat_id is not None else 0.0
+                if wait > 0:
+                    blocked.add(chat_id)
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                del lane[index]
+                return message, 0.0
+        return None, delay
+    
+    async def _run(self):
+        while True:
+            message, delay = self._next_ready()
+            if message is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            now = time.monotonic()
+            self._global.take()
+            if message.chat_id is not None:
+                self._chat_bucket(message.chat_id, now).take()
+                self._busy_chats.add(message.chat_id)
+            task = asyncio.get_running_loop().create_task(self._deliver(message))
+            self._deliveries.add(task)
+            task.add_done_callback(self._delivery_done)
+    
+    def _delivery_done(self, task):
+        self._deliveries.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Message delivery crashed: {task.exception()}")
+    
+    async def stop(self, timeout=DISPATCH_STOP_TIMEOUT):
+        """Дописывает очередь и ждет начатые отправки, но не дольше timeout, затем останавливает цикл.
+        
+        Что не успело уйти, завершается ошибкой у ждущих send(); уведомления и так лежат в outbox.
+        """
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._deliveries) and time.monotonic() < deadline:
+            if self._deliveries:
+                await asyncio.wait(set(self._deliveries), timeout=deadline - time.monotonic())
+            else:
+                await asyncio.sleep(0.05)
+        
+        tasks = list(self._deliveries)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        left = 0
+        for lane in self._lanes:
+            while lane:
+                left += 1
+                self._fail(lane.popleft(), RuntimeError("dispatcher stopped"))
+        if left:
+            logger.warning(f"Dispatcher stopped with {left} messages not sent")
+    
+    async def _deliver(self, message):
+        try:
+            result = await getattr(self._bot, message.method)(**message.kwargs)
+        except RetryAfter as e:
+            self.retry_after += 1
+            retry_after = retry_after_seconds(e)
+            if message.chat_id is not None:
+                self._chat_bucket(message.chat_id, time.monotonic()).paused_until = time.monotonic() + retry_after
+            if message.retries < DISPATCH_MAX_RETRIES:
+                message.retries += 1
+                logger.warning(f"RetryAfter {retry_after}s for chat {message.chat_id}, requeued")
+                self._lanes[message.priority].appendleft(message)
+            else:
+                self._fail(message, e)
+        except Exception as e:
+            self._fail(message, e)
+        else:
+            self.sent += 1
+            for future in message.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._busy_chats.discard(message.chat_id)
+            self._wakeup.set()
+    
+    def _fail(self, message, error):
+        self.failed += 1
+        if not message.futures:
+            logger.error(f"Failed to {message.method} to chat {message.chat_id}: {error}")
+        for future in message.futures:
+            if not future.done():
+                future.set_exception(error)
+    
+    def get_metrics(self):
+        """Метрики для админки"""
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retry_after': self.retry_after,
+            'failed': self.failed,
+        }
+
+dispatcher = MessageDispatcher()
+
+async def stop_dispatcher(application):
+    """post_stop: отправляет то, что осталось в очереди, пока бот еще работает"""
+    await dispatcher.stop()
+
+async def reply_text(update: Update, text, **kwargs):
+    """Ответ пользователю в его чат через диспетчер (вместо update.message.reply_text)"""
+    return await dispatcher.send('send_message', chat_id=update.effective_chat.id, text=text, **kwargs)
+
+async def edit_query_text(query, text, **kwargs):
+    """Правка сообщения с inline-кнопками через диспетчер (вместо query.edit_message_text)"""
+    return await dispatcher.send(
+        'edit_message_text',
+        chat_id=query.message.chat_id, message_id=query.message.message_id, text=text, **kwargs
+    )
+
+# --- ПРАВА ДОСТУПА ---
+# Кнопка, которая во время техобслуживания должна доходить до своего обработчика
+STATUS_BUTTON_TEXT = "🔄 Проверить статус"
+# Группа обработчиков проверки доступа: выполняется раньше всех остальных (группа 0)
+ACCESS_GUARD_GROUP = -1
+
+class AccessState:
+    """Права пользователя на время одного обновления: админ, бан, техобслуживание"""
+    
+    __slots__ = ('user_id', 'is_admin', 'banned', 'ban_reason', 'maintenance')
+    
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.is_admin = user_id in ADMIN_USER_IDS
+        # Админы не могут быть забанены и работают во время техобслуживания
+        self.banned = not self.is_admin and ban_registry.is_banned(user_id)
+        self.ban_reason = ban_registry.get_reason(user_id) if self.banned else None
+        self.maintenance = not self.is_admin and maintenance_state.is_active()
+
+def get_access(context, user_id):
+    """Права, которые access_guard уже вычислил для этого обновления (или вычисляет заново)"""
+    access = getattr(context, 'access', None)
+    if access is None or access.user_id != user_id:
+        access = AccessState(user_id)
+    return access
+
+async def access_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проверка доступа до маршрутизации: один раз на обновление.
+    
+    Кладет AccessState в context.access для обработчиков ниже и отсекает
+    забаненных и пользователей во время техобслуживания, не пуская
+    обновление дальше (ApplicationHandlerStop).
+    """
+    user = update.effective_user
+    if user is None:
+        return
+    access = context.access = AccessState(user.id)
+    if not access.banned and not access.maintenance:
+        return
+    
+    if (not access.banned and update.message is not None
+            and update.message.text == STATUS_BUTTON_TEXT):
+        return
+    
+    if update.callback_query is not None:
+        await update.callback_query.answer()
+    if update.effective_chat is not None:
+        if access.banned:
+            await check_ban(update, context, user.id)
+        else:
+            await check_maintenance(update, context, user.id)
+    raise ApplicationHandlerStop
+
 # --- ПРОВЕРКА БАНОВ ---
 async def check_ban(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int = None) -> bool:
     """Проверяет, забанен ли пользователь"""
     if user_id is None:
         user_id = update.effective_user.id
     
-    # Админы не могут быть забанены
-    if user_id in ADMIN_USER_IDS:
-        return False
+    access = get_access(context, user_id)
+    if access.banned:
+        reason = access.ban_reason or "Нарушение правил"
+        message = f"🚫 Вы забанены!\n\nПричина: {reason}\n\nДля разбирательства обратитесь к администратору."
         
-    if db.is_user_banned(user_id):
-        ban_info = db.get_banned_users()
-        user_ban = next((ban for ban in ban_info if ban[0] == user_id), None)
-        
-        if user_ban:
-            reason = user_ban[2] or "Нарушение правил"
-            message = f"🚫 Вы забанены!\n\nПричина: {reason}\n\nДля разбирательства обратитесь к администратору."
-            
-            await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
-            return True
+        await reply_text(update, message, reply_markup=ReplyKeyboardRemove())
+        return True
     
     return False
 
@@ -458,19 +2569,15 @@ async def check_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE,
     if user_id is None:
         user_id = update.effective_user.id
     
-    # Админы могут использовать бот даже во время техобслуживания
-    if user_id in ADMIN_USER_IDS:
-        return False
+    if get_access(context, user_id).maintenance:
+        message = maintenance_state.message or "⚙️ Бот находится на техническом обслуживании. Пожалуйста, попробуйте позже."
+        if maintenance_state.end:
+            message += f"\n\nОриентировочное окончание: {maintenance_state.end}"
         
-    maintenance_status = db.get_maintenance_status()
-    
-    if maintenance_status['maintenance_mode']:
-        message = maintenance_status['maintenance_message'] or "⚙️ Бот находится на техническом обслуживании. Пожалуйста, попробуйте позже."
-        
-        keyboard = [[KeyboardButton("🔄 Проверить статус")]]
+        keyboard = [[KeyboardButton(STATUS_BUTTON_TEXT)]]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
-        await update.message.reply_text(message, reply_markup=reply_markup)
+        await reply_text(update, message, reply_markup=reply_markup)
         return True
     return False
 
@@ -480,8 +2587,7 @@ async def check_maintenance_for_user(user_id: int) -> bool:
     if user_id in ADMIN_USER_IDS:
         return False
         
-    maintenance_status = db.get_maintenance_status()
-    return maintenance_status['maintenance_mode']
+    return maintenance_state.is_active()
 
 # --- ИСПРАВЛЕННАЯ ФУНКЦИЯ: Проверка статуса ---
 async def check_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -493,22 +2599,21 @@ async def check_status_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     # Админы всегда могут использовать бот
-    if user_id in ADMIN_USER_IDS:
+    access = get_access(context, user_id)
+    if access.is_admin:
         await start(update, context)
         return
     
-    maintenance_status = db.get_maintenance_status()
-    
-    if maintenance_status['maintenance_mode']:
-        message = maintenance_status['maintenance_message'] or "⚙️ Бот все еще находится на техническом обслуживании. Пожалуйста, попробуйте позже."
+    if access.maintenance:
+        message = maintenance_state.message or "⚙️ Бот все еще находится на техническом обслуживании. Пожалуйста, попробуйте позже."
         
-        keyboard = [[KeyboardButton("🔄 Проверить статус")]]
+        keyboard = [[KeyboardButton(STATUS_BUTTON_TEXT)]]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
-        await update.message.reply_text(message, reply_markup=reply_markup)
+        await reply_text(update, message, reply_markup=reply_markup)
     else:
         # Если техобслуживание закончилось, возвращаем в меню
-        await update.message.reply_text("✅ Бот снова активен! Возвращаемся в меню...")
+        await reply_text(update, "✅ Бот снова активен! Возвращаемся в меню...")
         await start(update, context)
 
 # --- НОВАЯ ФУНКЦИЯ: Очистка старых просмотренных анкет ---
@@ -537,12 +2642,14 @@ async def clear_history_handler(update: Update, context: ContextTypes.DEFAULT_TY
     if 'viewed_profiles' in user_data:
         user_data['viewed_profiles'] = []
     
-    if user_id in user_likes:
-        user_likes[user_id] = set()
+    forget_likes(user_id)
+    await adb.clear_likes(user_id)
     if user_id in user_dislikes:
-        user_dislikes[user_id] = set()
+        user_dislikes[user_id] = IdSet()
+        await adb.clear_dislikes(user_id)
+    swipe_decks.invalidate(user_id)
     
-    await update.message.reply_text("✅ История полностью очищена! Теперь вы увидите все анкеты заново.")
+    await reply_text(update, "✅ История полностью очищена! Теперь вы увидите все анкеты заново.")
 
 # --- НОВАЯ ФУНКЦИЯ: Полный сброс ---
 @auto_save
@@ -560,14 +2667,16 @@ async def reset_all_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data = context.user_data
     
     user_data.clear()
-    if user_id in user_likes:
-        user_likes[user_id] = set()
+    forget_likes(user_id)
+    await adb.clear_likes(user_id)
     if user_id in user_dislikes:
-        user_dislikes[user_id] = set()
-    if user_id in matched_users:
-        matched_users[user_id] = set()
+        user_dislikes[user_id] = IdSet()
+        await adb.clear_dislikes(user_id)
+    forget_matches(user_id)
+    await adb.clear_matches(user_id)
+    swipe_decks.invalidate(user_id)
     
-    await update.message.reply_text("🎯 Полный сброс выполнен! Все анкеты будут показаны заново.")
+    await reply_text(update, "🎯 Полный сброс выполнен! Все анкеты будут показаны заново.")
 
 # --- КОМАНДА ДЛЯ ПОЛУЧЕНИЯ ID ---
 async def get_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -578,7 +2687,7 @@ async def get_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await check_ban(update, context, user_id):
         return
         
-    await update.message.reply_text(f"Ваш ID: `{user_id}`", parse_mode='Markdown')
+    await reply_text(update, f"Ваш ID: `{user_id}`", parse_mode='Markdown')
 
 # --- КОМАНДА ДЛЯ ИНИЦИАЛИЗАЦИИ БАЗЫ ДАННЫХ ---
 async def init_db_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -586,30 +2695,46 @@ async def init_db_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой команде.")
+        await reply_text(update, "У вас нет доступа к этой команде.")
         return
     
     try:
-        db.init_db()
-        await update.message.reply_text("✅ База данных создана!")
+        await adb.init_db()
+        await reply_text(update, "✅ База данных создана!")
         
         # Перезагружаем данные
-        db.load_all_data()
-        await update.message.reply_text("✅ Данные загружены!")
+        await adb.load_all_data()
+        await adb.read(ban_registry.load, db)
+        await adb.read(maintenance_state.load, db)
+        rebuild_candidate_index()
+        swipe_decks.invalidate_all()
+        await reply_text(update, "✅ Данные загружены!")
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {e}")
+        await reply_text(update, f"❌ Ошибка: {e}")
+
+# --- КОМАНДА ДЛЯ РЕЗЕРВНОЙ КОПИИ ---
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запускает внеплановое резервное копирование БД"""
+    user_id = update.effective_user.id
+    
+    if user_id not in ADMIN_USER_IDS:
+        await reply_text(update, "У вас нет доступа к этой команде.")
+        return
+    
+    backup_manager.request_backup()
+    await reply_text(update, "💾 Резервное копирование запущено в фоне. Результат - в статистике.")
 
 # --- КОМАНДА ДЛЯ ОТЛАДКИ ПРОФИЛЯ ---
 async def debug_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для отладки профиля"""
     user_id = update.effective_user.id
     
-    await update.message.reply_text(
+    await reply_text(update,
         f"🔍 **Отладочная информация:**\n"
         f"ID: {user_id}\n"
         f"В памяти: {'Есть' if user_id in user_profiles else 'Нет'}\n"
         f"Заполнен: {'Да' if is_profile_complete(user_id) else 'Нет'}\n"
-        f"Забанен: {'Да' if db.is_user_banned(user_id) else 'Нет'}\n"
+        f"Забанен: {'Да' if ban_registry.is_banned(user_id) else 'Нет'}\n"
         f"Файл БД: {'Есть' if os.path.exists(DB_FILE) else 'Нет'}"
     )
 
@@ -619,7 +2744,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return MENU
     
     keyboard = [
@@ -629,12 +2754,11 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    maintenance_status = db.get_maintenance_status()
-    status_text = "🟢 Активен" if not maintenance_status['maintenance_mode'] else "🟡 Техобслуживание"
+    status_text = "🟢 Активен" if not maintenance_state.is_active() else "🟡 Техобслуживание"
     
-    banned_count = len(db.get_banned_users())
+    banned_count = len(ban_registry)
     
-    await update.message.reply_text(
+    await reply_text(update,
         f"⚙️ **Панель администратора**\n"
         f"Статус бота: {status_text}\n"
         f"Забанено пользователей: {banned_count}\n\n"
@@ -649,41 +2773,20 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return MENU
     
-    # Подключаемся к БД для более точной статистики
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Базовая статистика
+    # Все счетчики ведутся по событиям - ничего не пересчитываем
     total_profiles = len(user_profiles)
-    complete_profiles = len([uid for uid in user_profiles if is_profile_complete(uid)])
-    total_likes = sum(len(likes) for likes in user_likes.values())
-    total_matches = sum(len(matches) for matches in matched_users.values()) // 2
-    banned_count = len(db.get_banned_users())
-    
-    # Статистика по полу
-    cursor.execute('SELECT gender, COUNT(*) FROM users GROUP BY gender')
-    gender_stats = cursor.fetchall()
-    
-    # Статистика по возрасту
-    cursor.execute('SELECT age, COUNT(*) FROM users GROUP BY age ORDER BY age')
-    age_stats = cursor.fetchall()
-    
-    # Статистика по курсу
-    cursor.execute('SELECT city, COUNT(*) FROM users GROUP BY city ORDER BY city')
-    course_stats = cursor.fetchall()
-    
-    # Новые пользователи за последние 7 дней
-    cursor.execute('SELECT COUNT(*) FROM users WHERE created_at >= datetime("now", "-7 days")')
-    new_users_week = cursor.fetchone()[0]
-    
-    # Активность за последние 24 часа
-    cursor.execute('SELECT COUNT(*) FROM users WHERE last_active >= datetime("now", "-1 day")')
-    active_users_day = cursor.fetchone()[0]
-    
-    conn.close()
+    complete_profiles = bot_stats.complete_profiles
+    total_likes = bot_stats.total_likes
+    total_matches = bot_stats.total_matches
+    banned_count = len(ban_registry)
+    gender_stats = bot_stats.histogram(bot_stats.gender)
+    age_stats = bot_stats.histogram(bot_stats.age)
+    course_stats = bot_stats.histogram(bot_stats.course)
+    new_users_week = bot_stats.new_users()
+    active_users_day = bot_stats.active_today()
     
     stats_text = (
         f"📊 **Расширенная статистика бота:**\n\n"
@@ -694,7 +2797,7 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         f"• Совпадений: {total_matches}\n"
         f"• Забанено: {banned_count}\n"
         f"• Новых за неделю: {new_users_week}\n"
-        f"• Активных за сутки: {active_users_day}\n\n"
+        f"• Активных сегодня: {active_users_day}\n\n"
     )
     
     if gender_stats:
@@ -712,7 +2815,58 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         for course, count in course_stats:
             stats_text += f"• {course} курс: {count}\n"
     
-    await update.message.reply_text(stats_text)
+    write_metrics = write_behind.get_metrics()
+    stats_text += (
+        f"\n**Отложенная запись в БД:**\n"
+        f"• В очереди: {write_metrics['depth']}\n"
+        f"• Записано: {write_metrics['flushed_items']} за {write_metrics['flushes']} сбросов\n"
+        f"• Последний сброс: {write_metrics['last_flush_ms']:.1f} мс (макс. {write_metrics['max_flush_ms']:.1f} мс)\n"
+        f"• Ошибок сброса: {write_metrics['failed_flushes']}\n"
+    )
+    
+    dispatch_metrics = dispatcher.get_metrics()
+    stats_text += (
+        f"\n**Исходящие сообщения:**\n"
+        f"• В очереди: {dispatch_metrics['depth']}\n"
+        f"• Отправлено: {dispatch_metrics['sent']} (склеено: {dispatch_metrics['coalesced']})\n"
+        f"• RetryAfter: {dispatch_metrics['retry_after']}, ошибок: {dispatch_metrics['failed']}\n"
+    )
+    
+    deck_metrics = swipe_decks.get_metrics()
+    stats_text += (
+        f"\n**Колоды анкет:**\n"
+        f"• Колод: {deck_metrics['decks']}, ждут пополнения: {deck_metrics['pending']}\n"
+        f"• Пополнений: {deck_metrics['refills']}\n"
+    )
+    
+    if SHARD_COUNT > 1:
+        stats_text += f"\n**Воркер:** {SHARD_INDEX + 1} из {SHARD_COUNT} (очереди и отправка - только этого воркера)\n"
+    
+    outbox_metrics = outbox.get_metrics()
+    outbox_rows = await adb.outbox_counts()
+    stats_text += (
+        f"\n**Очередь уведомлений (outbox):**\n"
+        f"• Ожидают: {outbox_rows.get('pending', 0)}, в dead-letter: {outbox_rows.get('dead', 0)}\n"
+        f"• Доставлено: {outbox_metrics['delivered']}, повторов: {outbox_metrics['retried']}, "
+        f"RetryAfter: {outbox_metrics['retry_after']}\n"
+    )
+    
+    backup_metrics = backup_manager.get_metrics()
+    stats_text += (
+        f"\n**Резервные копии:**\n"
+        f"• Сделано: {backup_metrics['backups_done']} (ошибок: {backup_metrics['failures']})\n"
+    )
+    if backup_metrics['last_finished_at']:
+        stats_text += (
+            f"• Последняя: {backup_metrics['last_finished_at']}, "
+            f"{backup_metrics['last_duration']:.1f} с, {backup_metrics['last_size'] // 1024} КБ\n"
+        )
+    stats_text += (
+        f"• Снимков индексов: {index_snapshot_manager.snapshots_done} "
+        f"(ошибок: {index_snapshot_manager.failures})\n"
+    )
+    
+    await reply_text(update, stats_text)
     return ADMIN_PANEL
 
 # --- УПРАВЛЕНИЕ ТЕХОБСЛУЖИВАНИЕМ ---
@@ -721,19 +2875,18 @@ async def maintenance_management(update: Update, context: ContextTypes.DEFAULT_T
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return MENU
     
-    maintenance_status = db.get_maintenance_status()
-    
-    if maintenance_status['maintenance_mode']:
+    if maintenance_state.is_active():
         keyboard = [
             [KeyboardButton("🟢 Выключить техобслуживание")],
-            [KeyboardButton("✏️ Изменить сообщение")],
+            [KeyboardButton("✏️ Изменить сообщение"), KeyboardButton("⏱ Время окончания")],
             [KeyboardButton("⬅️ Назад в админку")]
         ]
         status_text = "🟡 ВКЛЮЧЕНО"
-        message_text = maintenance_status['maintenance_message'] or "Сообщение не установлено"
+        message_text = maintenance_state.message or "Сообщение не установлено"
+        end_text = maintenance_state.end or "Не задано"
     else:
         keyboard = [
             [KeyboardButton("🔴 Включить техобслуживание")],
@@ -741,13 +2894,15 @@ async def maintenance_management(update: Update, context: ContextTypes.DEFAULT_T
         ]
         status_text = "🟢 ВЫКЛЮЧЕНО"
         message_text = "Не активно"
+        end_text = "—"
     
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    await update.message.reply_text(
+    await reply_text(update,
         f"🛠️ **Управление техобслуживанием**\n\n"
         f"Статус: {status_text}\n"
-        f"Сообщение: {message_text}\n\n"
+        f"Сообщение: {message_text}\n"
+        f"Окончание: {end_text}\n\n"
         f"Выберите действие:",
         reply_markup=reply_markup
     )
@@ -758,19 +2913,17 @@ async def toggle_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return MENU
     
-    maintenance_status = db.get_maintenance_status()
-    
-    if maintenance_status['maintenance_mode']:
+    if maintenance_state.is_active():
         # Выключаем техобслуживание
-        db.set_maintenance_mode(False)
-        await update.message.reply_text("🟢 Техобслуживание выключено! Бот снова активен.")
+        await maintenance_state.set(False)
+        await reply_text(update, "🟢 Техобслуживание выключено! Бот снова активен.")
     else:
         # Включаем техобслуживание
-        db.set_maintenance_mode(True, "⚙️ Бот находится на техническом обслуживании. Пожалуйста, попробуйте позже.")
-        await update.message.reply_text("🔴 Техобслуживание включено! Бот временно недоступен для пользователей.")
+        await maintenance_state.set(True, "⚙️ Бот находится на техническом обслуживании. Пожалуйста, попробуйте позже.")
+        await reply_text(update, "🔴 Техобслуживание включено! Бот временно недоступен для пользователей.")
     
     return await maintenance_management(update, context)
 
@@ -779,14 +2932,15 @@ async def set_maintenance_message(update: Update, context: ContextTypes.DEFAULT_
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return MENU
     
-    await update.message.reply_text(
+    await reply_text(update,
         "Введите сообщение, которое будут видеть пользователи во время техобслуживания:",
         reply_markup=ReplyKeyboardMarkup([[KeyboardButton("⬅️ Отмена")]], resize_keyboard=True)
     )
     context.user_data['waiting_for_maintenance_message'] = True
+    context.user_data.pop('waiting_for_maintenance_end', None)
     return ADMIN_PANEL
 
 async def save_maintenance_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -794,13 +2948,55 @@ async def save_maintenance_message(update: Update, context: ContextTypes.DEFAULT
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return MENU
     
+    # Ждем время окончания, а не текст сообщения
+    if context.user_data.pop('waiting_for_maintenance_end', None):
+        return await save_maintenance_end(update, context)
+    
     message = update.message.text
-    db.set_maintenance_mode(True, message)
+    await maintenance_state.set(True, message, maintenance_state.end)
+    context.user_data.pop('waiting_for_maintenance_message', None)
     
-    await update.message.reply_text("✅ Сообщение техобслуживания обновлено!")
+    await reply_text(update, "✅ Сообщение техобслуживания обновлено!")
+    return await maintenance_management(update, context)
+
+async def set_maintenance_end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Запрашивает, через сколько минут закончится техобслуживание"""
+    user_id = update.effective_user.id
+    
+    if user_id not in ADMIN_USER_IDS:
+        await reply_text(update, "У вас нет доступа к этой функции.")
+        return MENU
+    
+    await reply_text(update,
+        "Через сколько минут автоматически выключить техобслуживание?\n"
+        "Введите 0, чтобы убрать время окончания:",
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("⬅️ Отмена")]], resize_keyboard=True)
+    )
+    context.user_data['waiting_for_maintenance_end'] = True
+    return ADMIN_PANEL
+
+async def save_maintenance_end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Сохраняет время окончания техобслуживания"""
+    try:
+        minutes = int(update.message.text)
+        if minutes < 0:
+            raise ValueError
+    except ValueError:
+        await reply_text(update, "❌ Введите целое число минут.")
+        return await maintenance_management(update, context)
+    
+    end_time = None
+    if minutes:
+        end_time = (datetime.now() + timedelta(minutes=minutes)).strftime(MAINTENANCE_END_FORMAT)
+    await maintenance_state.set(True, maintenance_state.message, end_time)
+    
+    if end_time:
+        await reply_text(update, f"✅ Техобслуживание выключится автоматически в {end_time}")
+    else:
+        await reply_text(update, "✅ Время окончания убрано.")
     return await maintenance_management(update, context)
 
 # --- УПРАВЛЕНИЕ БАНАМИ ---
@@ -809,10 +3005,10 @@ async def ban_management(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return ADMIN_PANEL
     
-    banned_users = db.get_banned_users()
+    banned_users = ban_registry.list_bans()
     
     keyboard = [
         [KeyboardButton("🔨 Забанить пользователя")],
@@ -824,7 +3020,7 @@ async def ban_management(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     ban_count = len(banned_users)
     
-    await update.message.reply_text(
+    await reply_text(update,
         f"🔨 **Управление банами**\n\n"
         f"Забанено пользователей: {ban_count}\n\n"
         f"Выберите действие:",
@@ -837,19 +3033,19 @@ async def show_banned_users(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return ADMIN_PANEL
     
-    banned_users = db.get_banned_users()
+    banned_users = ban_registry.list_bans()
     
     if not banned_users:
-        await update.message.reply_text("🚫 Нет забаненных пользователей.")
+        await reply_text(update, "🚫 Нет забаненных пользователей.")
         return await ban_management(update, context)
     
     ban_list = "📋 **Список забаненных пользователей:**\n\n"
     
     for i, (banned_id, username, reason, banned_at) in enumerate(banned_users, 1):
-        user_info = db.get_user_info(banned_id)
+        user_info = await adb.get_user_info(banned_id)
         name = user_info[3] if user_info else "Неизвестно"
         ban_list += f"{i}. ID: {banned_id}\n"
         ban_list += f"   Имя: {name}\n"
@@ -857,7 +3053,7 @@ async def show_banned_users(update: Update, context: ContextTypes.DEFAULT_TYPE)
         ban_list += f"   Причина: {reason or 'Не указана'}\n"
         ban_list += f"   Забанен: {banned_at[:16]}\n\n"
     
-    await update.message.reply_text(ban_list)
+    await reply_text(update, ban_list)
     return BAN_MANAGEMENT
 
 async def ban_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -865,15 +3061,16 @@ async def ban_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return ADMIN_PANEL
     
-    await update.message.reply_text(
+    await reply_text(update,
         "Введите ID пользователя для бана:\n\n"
         "Чтобы узнать ID пользователя, попросите его отправить команду /id",
         reply_markup=ReplyKeyboardMarkup([[KeyboardButton("⬅️ Отмена")]], resize_keyboard=True)
     )
     context.user_data['waiting_for_ban_user_id'] = True
+    context.user_data.pop('waiting_for_ban_reason', None)
     return BAN_MANAGEMENT
 
 async def ban_user_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -881,32 +3078,36 @@ async def ban_user_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return ADMIN_PANEL
     
+    # ID уже введен - значит, это текст причины бана
+    if context.user_data.get('waiting_for_ban_reason'):
+        return await confirm_ban(update, context)
+    
     try:
         target_user_id = int(update.message.text)
         
         # Проверяем, существует ли пользователь
-        target_user = db.get_user_info(target_user_id)
+        target_user = await adb.get_user_info(target_user_id)
         if not target_user:
-            await update.message.reply_text("❌ Пользователь с таким ID не найден.")
+            await reply_text(update, "❌ Пользователь с таким ID не найден.")
             return await ban_management(update, context)
         
         # Проверяем, не забанен ли уже
-        if db.is_user_banned(target_user_id):
-            await update.message.reply_text("❌ Этот пользователь уже забанен.")
+        if ban_registry.is_banned(target_user_id):
+            await reply_text(update, "❌ Этот пользователь уже забанен.")
             return await ban_management(update, context)
         
         # Проверяем, не админ ли
         if target_user_id in ADMIN_USER_IDS:
-            await update.message.reply_text("❌ Нельзя забанить администратора.")
+            await reply_text(update, "❌ Нельзя забанить администратора.")
             return await ban_management(update, context)
         
         context.user_data['ban_target_id'] = target_user_id
         context.user_data['ban_target_username'] = target_user[1]  # username из БД
         
-        await update.message.reply_text(
+        await reply_text(update,
             f"Пользователь: {target_user[3]} (@{target_user[1]})\n"
             f"ID: {target_user_id}\n\n"
             "Введите причину бана:",
@@ -915,7 +3116,7 @@ async def ban_user_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context.user_data['waiting_for_ban_reason'] = True
         
     except ValueError:
-        await update.message.reply_text("❌ Неверный формат ID. Введите числовой ID.")
+        await reply_text(update, "❌ Неверный формат ID. Введите числовой ID.")
         return await ban_management(update, context)
     
     return BAN_MANAGEMENT
@@ -925,7 +3126,7 @@ async def confirm_ban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return ADMIN_PANEL
     
     target_user_id = context.user_data.get('ban_target_id')
@@ -933,11 +3134,13 @@ async def confirm_ban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     reason = update.message.text
     
     if not target_user_id:
-        await update.message.reply_text("❌ Ошибка: не найден ID пользователя для бана.")
+        await reply_text(update, "❌ Ошибка: не найден ID пользователя для бана.")
         return await ban_management(update, context)
     
     # Выполняем бан
-    db.ban_user(target_user_id, target_username, reason, user_id)
+    await ban_registry.ban(target_user_id, target_username, reason, user_id)
+    refresh_candidate(target_user_id)
+    swipe_decks.invalidate_all()
     
     # Очищаем временные данные
     context.user_data.pop('ban_target_id', None)
@@ -945,20 +3148,18 @@ async def confirm_ban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     context.user_data.pop('waiting_for_ban_user_id', None)
     context.user_data.pop('waiting_for_ban_reason', None)
     
-    target_user_info = db.get_user_info(target_user_id)
+    target_user_info = await adb.get_user_info(target_user_id)
     target_name = target_user_info[3] if target_user_info else "Неизвестно"
     
-    await update.message.reply_text(
+    await reply_text(update,
         f"✅ Пользователь {target_name} (@{target_username}) забанен!\n"
         f"Причина: {reason}"
     )
     
-    # Отправляем уведомление забаненному пользователю (если он активен)
-    try:
-        ban_message = f"🚫 Вы были забанены администратором.\n\nПричина: {reason}\n\nДля разбирательства обратитесь к администратору."
-        await context.bot.send_message(chat_id=target_user_id, text=ban_message)
-    except Exception as e:
-        logger.warning(f"Не удалось отправить уведомление о бане пользователю {target_user_id}: {e}")
+    # Отправляем уведомление забаненному пользователю (если он активен);
+    # ошибку отправки диспетчер только залогирует
+    ban_message = f"🚫 Вы были забанены администратором.\n\nПричина: {reason}\n\nДля разбирательства обратитесь к администратору."
+    dispatcher.post('send_message', chat_id=target_user_id, text=ban_message)
     
     return await ban_management(update, context)
 
@@ -967,18 +3168,18 @@ async def unban_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return ADMIN_PANEL
     
-    banned_users = db.get_banned_users()
+    banned_users = ban_registry.list_bans()
     
     if not banned_users:
-        await update.message.reply_text("🚫 Нет забаненных пользователей для разбана.")
+        await reply_text(update, "🚫 Нет забаненных пользователей для разбана.")
         return await ban_management(update, context)
     
     keyboard = []
     for banned_id, username, reason, banned_at in banned_users:
-        user_info = db.get_user_info(banned_id)
+        user_info = await adb.get_user_info(banned_id)
         name = user_info[3] if user_info else "Неизвестно"
         button_text = f"🔓 {name} (ID: {banned_id})"
         keyboard.append([KeyboardButton(button_text)])
@@ -986,7 +3187,7 @@ async def unban_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     keyboard.append([KeyboardButton("⬅️ Отмена")])
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    await update.message.reply_text(
+    await reply_text(update,
         "Выберите пользователя для разбана:",
         reply_markup=reply_markup
     )
@@ -999,7 +3200,7 @@ async def execute_unban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("У вас нет доступа к этой функции.")
+        await reply_text(update, "У вас нет доступа к этой функции.")
         return ADMIN_PANEL
     
     button_text = update.message.text
@@ -1008,45 +3209,305 @@ async def execute_unban(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     try:
         target_user_id = int(button_text.split("ID: ")[1].split(")")[0])
     except (IndexError, ValueError):
-        await update.message.reply_text("❌ Ошибка при обработке выбора.")
+        await reply_text(update, "❌ Ошибка при обработке выбора.")
         return await ban_management(update, context)
     
     # Выполняем разбан
-    db.unban_user(target_user_id)
+    await ban_registry.unban(target_user_id)
+    refresh_candidate(target_user_id)
+    swipe_decks.invalidate_all()
     
-    target_user_info = db.get_user_info(target_user_id)
+    target_user_info = await adb.get_user_info(target_user_id)
     target_name = target_user_info[3] if target_user_info else "Неизвестно"
     target_username = target_user_info[1] if target_user_info else "Неизвестно"
     
-    await update.message.reply_text(
+    await reply_text(update,
         f"✅ Пользователь {target_name} (@{target_username}) разбанен!"
     )
     
     # Отправляем уведомление разбаненному пользователю
-    try:
-        unban_message = "🎉 Вы были разбанены! Теперь вы снова можете пользоваться ботом."
-        await context.bot.send_message(chat_id=target_user_id, text=unban_message)
-    except Exception as e:
-        logger.warning(f"Не удалось отправить уведомление о разбане пользователю {target_user_id}: {e}")
+    unban_message = "🎉 Вы были разбанены! Теперь вы снова можете пользоваться ботом."
+    dispatcher.post('send_message', chat_id=target_user_id, text=unban_message)
     
     context.user_data.pop('waiting_for_unban', None)
     return await ban_management(update, context)
 
 # --- ОСНОВНЫЕ ФУНКЦИИ БОТА ---
 def is_profile_complete(user_id):
+    """Заполнена ли анкета (флаг обновляется при сохранении профиля)"""
     profile = user_profiles.get(user_id)
-    return (
-        profile
-        and profile.get("gender")
-        and profile.get("name")
-        and profile.get("age")
-        and profile.get("city")
-        and profile.get("bio")
-        and profile.get("photo")
-        and profile.get("username")
+    return bool(profile and profile.complete)
+
+# --- ИНДЕКС АНКЕТ ДЛЯ ПОИСКА ---
+# Сколько случайных попыток делать на одну анкету выборки, прежде чем перебирать индекс подряд
+CANDIDATE_SAMPLE_ATTEMPTS = 2
+
+class CandidateIndex:
+    """Заполненные анкеты незабаненных пользователей.
+    
+    Массив id плюс карта позиций: добавление, удаление и случайный
+    выбор за O(1), без обхода всех user_profiles на каждый свайп.
+    """
+    
+    def __init__(self):
+        self._ids = []
+        self._positions = {}
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    def __contains__(self, user_id):
+        return user_id in self._positions
+    
+    def add(self, user_id):
+        if user_id in self._positions:
+            return
+        self._positions[user_id] = len(self._ids)
+        self._ids.append(user_id)
+    
+    def discard(self, user_id):
+        position = self._positions.pop(user_id, None)
+        if position is None:
+            return
+        # На место удаленного ставим последний элемент
+        last_id = self._ids.pop()
+        if position < len(self._ids):
+            self._ids[position] = last_id
+            self._positions[last_id] = position
+    
+    def clear(self):
+        self._ids = []
+        self._positions = {}
+    
+    def sample(self, is_excluded, size, attempts=CANDIDATE_SAMPLE_ATTEMPTS):
+        """До size разных случайных анкет, для которых is_excluded(id) ложно"""
+        ids = self._ids
+        count = len(ids)
+        if count <= size:
+            return [candidate_id for candidate_id in ids if not is_excluded(candidate_id)]
+        
+        # Обычно исключена малая доля анкет - случайных попыток хватает
+        found = {}
+        for _ in range(size * attempts):
+            candidate_id = ids[random.randrange(count)]
+            if candidate_id not in found and not is_excluded(candidate_id):
+                found[candidate_id] = None
+                if len(found) == size:
+                    return list(found)
+        if found:
+            return list(found)
+        
+        # Почти все исключены: обходим индекс по кругу со случайного места
+        start = random.randrange(count)
+        for offset in range(count):
+            candidate_id = ids[(start + offset) % count]
+            if not is_excluded(candidate_id):
+                found[candidate_id] = None
+                if len(found) == size:
+                    break
+        return list(found)
+
+candidate_index = CandidateIndex()
+
+def refresh_candidate(user_id):
+    """Добавляет анкету в индекс поиска или убирает из него"""
+    if is_profile_complete(user_id) and not ban_registry.is_banned(user_id):
+        candidate_index.add(user_id)
+    else:
+        candidate_index.discard(user_id)
+
+def rebuild_candidate_index():
+    """Строит индекс поиска заново по всем профилям"""
+    candidate_index.clear()
+    for user_id in user_profiles:
+        refresh_candidate(user_id)
+    logger.info(f"Candidate index built: {len(candidate_index)} profiles")
+
+# --- РАНЖИРОВАНИЕ АНКЕТ ---
+# Сколько анкет случайно выбирать из индекса для ранжирования на один свайп
+RANK_POOL_SIZE = 64
+# Из скольких лучших анкет выборки случайно берем следующую, чтобы лента не застывала
+RANK_TOP_K = 3
+# Веса сигналов
+RANK_WEIGHT_LIKED_VIEWER = 3.0
+RANK_WEIGHT_RECENCY = 2.0
+RANK_WEIGHT_SAME_COURSE = 1.0
+RANK_WEIGHT_AGE_GAP = 1.0
+# Через сколько дней неактивности вклад свежести падает вдвое
+RANK_RECENCY_HALF_LIFE_DAYS = 7
+# Разница в возрасте, начиная с которой штраф максимальный
+RANK_MAX_AGE_GAP = 5
+
+def _timestamp_to_epoch(timestamp):
+    """'YYYY-MM-DD HH:MM:SS' в UTC (как пишет SQLite) -> секунды, или None"""
+    if not timestamp:
+        return None
+    try:
+        return datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def score_candidate(viewer_profile, likers, candidate_id, now):
+    """Чем выше, тем раньше стоит показать анкету.
+    
+    likers - кто уже лайкнул смотрящего: показ такой анкеты почти
+    гарантирует совпадение.
+    """
+    candidate = user_profiles[candidate_id]
+    score = 0.0
+    
+    if candidate_id in likers:
+        score += RANK_WEIGHT_LIKED_VIEWER
+    
+    last_active = _timestamp_to_epoch(candidate.get('last_active'))
+    if last_active is not None:
+        idle_days = max(0.0, now - last_active) / 86400
+        score += RANK_WEIGHT_RECENCY * 0.5 ** (idle_days / RANK_RECENCY_HALF_LIFE_DAYS)
+    
+    if viewer_profile is not None:
+        course = viewer_profile.get('city')
+        if course is not None and candidate.get('city') == course:
+            score += RANK_WEIGHT_SAME_COURSE
+        
+        viewer_age, candidate_age = viewer_profile.get('age'), candidate.get('age')
+        if isinstance(viewer_age, int) and isinstance(candidate_age, int):
+            gap = min(abs(viewer_age - candidate_age), RANK_MAX_AGE_GAP)
+            score -= RANK_WEIGHT_AGE_GAP * gap / RANK_MAX_AGE_GAP
+    return score
+
+def rank_candidates(viewer_id, candidate_ids, limit=RANK_TOP_K):
+    """Лучшие limit анкет по score_candidate - куча на limit элементов, без сортировки всех"""
+    viewer_profile = user_profiles.get(viewer_id)
+    likers = user_liked_by.get(viewer_id, ())
+    now = time.time()
+    return heapq.nlargest(
+        limit, candidate_ids,
+        key=lambda candidate_id: score_candidate(viewer_profile, likers, candidate_id, now)
     )
 
-async def send_profile_card(user_id: int, target_user_id: int, context: ContextTypes.DEFAULT_TYPE, reply_markup=None):
+def pick_candidate(viewer_id, is_excluded):
+    """Следующая анкета для показа или None"""
+    pool = candidate_index.sample(is_excluded, RANK_POOL_SIZE)
+    if not pool:
+        return None
+    return random.choice(rank_candidates(viewer_id, pool))
+
+def search_exclusion(user_id):
+    """Функция is_excluded для поиска: сам пользователь, лайкнутые, пропущенные и совпадения"""
+    liked = user_likes.get(user_id, ())
+    disliked = user_dislikes.get(user_id, ())
+    matched = matched_users.get(user_id, ())
+    
+    def is_excluded(profile_id):
+        return (profile_id == user_id
+                or profile_id in liked
+                or profile_id in disliked
+                or profile_id in matched)
+    return is_excluded
+
+# --- КОЛОДЫ АНКЕТ ---
+# Сколько следующих анкет держать наготове для каждого пользователя
+DECK_SIZE = 10
+# Когда в колоде остается столько анкет, ставим ее в очередь на пополнение
+DECK_LOW_WATER = 3
+# Как часто фоновая задача пополняет колоды (секунды)
+DECK_REFILL_INTERVAL = 2
+# Сколько колод пополнять за один запуск
+DECK_REFILL_BATCH = 200
+# Сколько колод ранжировать подряд, прежде чем отдать управление event loop
+DECK_REFILL_SLICE = 8
+
+class SwipeDecks:
+    """Заранее отранжированные очереди анкет для активных пользователей.
+    
+    Хендлер только снимает id с колоды, а ранжирование выполняет фоновая
+    задача job_queue. Баны сбрасывают все колоды сразу - через номер
+    поколения, без обхода; правка анкеты сбрасывает колоду ее владельца.
+    """
+    
+    def __init__(self):
+        self._decks = {}  # user_id -> (поколение, deque id)
+        self._generation = 0
+        self._refill_queue = {}  # user_id -> None, в порядке запроса
+        self.refills = 0
+    
+    def __len__(self):
+        return len(self._decks)
+    
+    def invalidate(self, user_id):
+        """Сбрасывает колоду одного пользователя"""
+        self._decks.pop(user_id, None)
+    
+    def invalidate_all(self):
+        """Сбрасывает все колоды: устаревшие пересоберутся при следующем запросе"""
+        self._generation += 1
+    
+    def request_refill(self, user_id):
+        self._refill_queue[user_id] = None
+    
+    def pop(self, user_id, is_excluded):
+        """Следующая анкета из колоды или None, если колоды нет или она кончилась"""
+        entry = self._decks.get(user_id)
+        if entry is None or entry[0] != self._generation:
+            self._decks.pop(user_id, None)
+            self.request_refill(user_id)
+            return None
+        
+        deck = entry[1]
+        while deck:
+            candidate_id = deck.popleft()
+            # За время в колоде анкету могли забанить, опустошить или уже оценить
+            if candidate_id in candidate_index and not is_excluded(candidate_id):
+                if len(deck) <= DECK_LOW_WATER:
+                    self.request_refill(user_id)
+                return candidate_id
+        self.request_refill(user_id)
+        return None
+    
+    def refill(self, user_id):
+        """Собирает колоду заново: выборка из индекса, лучшие DECK_SIZE по рангу"""
+        is_excluded = search_exclusion(user_id)
+        pool = candidate_index.sample(is_excluded, RANK_POOL_SIZE)
+        self._decks[user_id] = (self._generation, deque(rank_candidates(user_id, pool, DECK_SIZE)))
+        self.refills += 1
+    
+    def refill_pending(self, limit=DECK_REFILL_BATCH):
+        """Пополняет до limit колод из очереди. Возвращает, сколько пополнено"""
+        done = 0
+        while self._refill_queue and done < limit:
+            user_id = next(iter(self._refill_queue))
+            del self._refill_queue[user_id]
+            if user_id in user_profiles:
+                self.refill(user_id)
+                done += 1
+        return done
+    
+    def get_metrics(self):
+        """Счетчики колод для админки"""
+        return {
+            'decks': len(self._decks),
+            'pending': len(self._refill_queue),
+            'refills': self.refills,
+        }
+
+swipe_decks = SwipeDecks()
+
+async def refill_decks_job(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая задача job_queue: пополняет колоды, которые просили хендлеры.
+    
+    Ранжирует небольшими порциями: между ними event loop успевает
+    обработать апдейты, а не ждет все DECK_REFILL_BATCH колод разом.
+    """
+    done = 0
+    while done < DECK_REFILL_BATCH:
+        refilled = swipe_decks.refill_pending(min(DECK_REFILL_SLICE, DECK_REFILL_BATCH - done))
+        if not refilled:
+            break
+        done += refilled
+        await asyncio.sleep(0)
+
+async def send_profile_card(user_id: int, target_user_id: int, context: ContextTypes.DEFAULT_TYPE, reply_markup=None,
+                            priority=PRIORITY_INTERACTIVE, header=None):
     profile = user_profiles.get(target_user_id)
     if not profile:
         logger.error(f"Profile not found for user ID: {target_user_id}")
@@ -1054,6 +3515,7 @@ async def send_profile_card(user_id: int, target_user_id: int, context: ContextT
 
     bio_text = profile.get("bio", "Нет информации")
     message_text = (
+        (f"{header}\n\n" if header else "") +
         f"Имя: {profile['name']}\n"
         f"Возраст: {profile['age']}\n"
         f"Курс: {profile['city']}\n"
@@ -1062,7 +3524,9 @@ async def send_profile_card(user_id: int, target_user_id: int, context: ContextT
 
     if profile.get("photo"):
         try:
-            await context.bot.send_photo(
+            await dispatcher.send(
+                'send_photo',
+                priority,
                 chat_id=user_id,
                 photo=profile["photo"],
                 caption=message_text,
@@ -1070,26 +3534,41 @@ async def send_profile_card(user_id: int, target_user_id: int, context: ContextT
             )
         except Exception as e:
             logger.error(f"Failed to send photo to {user_id}: {e}")
-            await context.bot.send_message(
+            await dispatcher.send(
+                'send_message',
+                priority,
                 chat_id=user_id,
                 text=message_text + "\n(Не удалось загрузить фото)",
                 reply_markup=reply_markup
             )
     else:
-        await context.bot.send_message(
+        await dispatcher.send(
+            'send_message',
+            priority,
             chat_id=user_id,
             text=message_text + "\n(Фото отсутствует)",
             reply_markup=reply_markup
         )
 
+def main_menu_markup(user_id):
+    """Клавиатура главного меню"""
+    keyboard = [
+        [KeyboardButton("Поиск")],
+        [KeyboardButton("💌 Меня лайкнули")],
+        [KeyboardButton("Настройки")],
+    ]
+    if user_id in ADMIN_USER_IDS:
+        keyboard.append([KeyboardButton("⚙️ Админка")])
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
 # --- ИСПРАВЛЕННАЯ ФУНКЦИЯ START ---
 @auto_save
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks the user about their gender."""
     user_id = update.effective_user.id
     
-    # 🔥 ПЕРЕЗАГРУЖАЕМ ДАННЫЕ ИЗ БАЗЫ
-    db.load_all_data()
+    # 🔥 ПОДТЯГИВАЕМ ИЗМЕНЕНИЯ ИЗ БАЗЫ (только если в нее кто-то писал)
+    await sync_data()
     
     # Проверяем бан
     if await check_ban(update, context, user_id):
@@ -1101,23 +3580,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         
     # Store username early
     if user_id not in user_profiles:
-        user_profiles[user_id] = {}
+        user_profiles[user_id] = Profile()
     user_profiles[user_id]["username"] = update.effective_user.username
     # Сохраняем в БД
-    db.save_user(user_id, user_profiles[user_id])
+    await save_profile(user_id)
 
     if is_profile_complete(user_id):
-        keyboard = [
-            [KeyboardButton("Поиск")],
-            [KeyboardButton("Настройки")],
-        ]
+        reply_markup = main_menu_markup(user_id)
         
-        if user_id in ADMIN_USER_IDS:
-            keyboard.append([KeyboardButton("⚙️ Админка")])
-            
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
-        await update.message.reply_text(
+        await reply_text(update,
             "Привет! Твой профиль уже заполнен. Что хочешь сделать?",
             reply_markup=reply_markup,
         )
@@ -1126,7 +3597,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         keyboard = [["Мужской"], ["Женский"], ["Другое"]]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
 
-        await update.message.reply_text(
+        await reply_text(update,
             "Привет! Давай создадим твой профиль. Сначала укажи свой пол:",
             reply_markup=reply_markup,
         )
@@ -1147,15 +3618,15 @@ async def gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         
     context.user_data["gender"] = update.message.text
     if user_id not in user_profiles:
-        user_profiles[user_id] = {}
+        user_profiles[user_id] = Profile()
     user_profiles[user_id]["gender"] = update.message.text
     if "username" not in user_profiles[user_id]:
         user_profiles[user_id]["username"] = update.effective_user.username
     
     # Сохраняем в БД
-    db.save_user(user_id, user_profiles[user_id])
+    await save_profile(user_id)
 
-    await update.message.reply_text(
+    await reply_text(update,
         "Отлично! Теперь укажи свое имя:", reply_markup=ReplyKeyboardRemove()
     )
     return NAME
@@ -1174,9 +3645,9 @@ async def name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         
     context.user_data["name"] = update.message.text
     user_profiles[user_id]["name"] = update.message.text
-    db.save_user(user_id, user_profiles[user_id])
+    await save_profile(user_id)
 
-    await update.message.reply_text("Сколько тебе лет? (от 16 до 25)")
+    await reply_text(update, "Сколько тебе лет? (от 16 до 25)")
     return AGE
 
 @auto_save
@@ -1194,18 +3665,18 @@ async def age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         age = int(update.message.text)
         if age < 16 or age > 25:
-            await update.message.reply_text(
+            await reply_text(update,
                 "Пожалуйста, укажите реальный возраст (16-25):"
             )
             return AGE
         context.user_data["age"] = age
         user_profiles[user_id]["age"] = age
-        db.save_user(user_id, user_profiles[user_id])
+        await save_profile(user_id)
 
-        await update.message.reply_text("Укажите свой курс (от 1 до 5):")
+        await reply_text(update, "Укажите свой курс (от 1 до 5):")
         return CITY
     except ValueError:
-        await update.message.reply_text("Пожалуйста, укажите возраст цифрами.")
+        await reply_text(update, "Пожалуйста, укажите возраст цифрами.")
         return AGE
 
 @auto_save
@@ -1223,18 +3694,18 @@ async def city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         course = int(update.message.text)
         if course < 1 or course > 5:
-            await update.message.reply_text(
+            await reply_text(update,
                 "Пожалуйста, укажите реальный курс (1-5):"
             )
             return CITY
         context.user_data["city"] = course
         user_profiles[user_id]["city"] = course
-        db.save_user(user_id, user_profiles[user_id])
+        await save_profile(user_id)
 
-        await update.message.reply_text("Расскажи немного о себе (интересы, хобби и т.д.):")
+        await reply_text(update, "Расскажи немного о себе (интересы, хобби и т.д.):")
         return BIO
     except ValueError:
-        await update.message.reply_text("Пожалуйста, укажите курс цифрами (1-5).")
+        await reply_text(update, "Пожалуйста, укажите курс цифрами (1-5).")
         return CITY
 
 @auto_save
@@ -1251,9 +3722,9 @@ async def bio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         
     context.user_data["bio"] = update.message.text
     user_profiles[user_id]["bio"] = update.message.text
-    db.save_user(user_id, user_profiles[user_id])
+    await save_profile(user_id)
 
-    await update.message.reply_text("Теперь отправь свою лучшую фотографию:")
+    await reply_text(update, "Теперь отправь свою лучшую фотографию:")
     return PHOTO
 
 @auto_save
@@ -1272,7 +3743,7 @@ async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         photo_file_id = update.message.photo[-1].file_id
         context.user_data["photo"] = photo_file_id
         user_profiles[user_id]["photo"] = photo_file_id
-        db.save_user(user_id, user_profiles[user_id])
+        await save_profile(user_id)
 
         profile = user_profiles[user_id]
         bio_text = profile.get("bio", "Нет информации")
@@ -1290,7 +3761,8 @@ async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         ]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
 
-        await context.bot.send_photo(
+        await dispatcher.send(
+            'send_photo',
             chat_id=user_id,
             photo=photo_file_id,
             caption=message_text,
@@ -1298,7 +3770,7 @@ async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return CONFIRMATION
     else:
-        await update.message.reply_text("Пожалуйста, отправь фотографию.")
+        await reply_text(update, "Пожалуйста, отправь фотографию.")
         return PHOTO
 
 @auto_save
@@ -1314,17 +3786,9 @@ async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         return ConversationHandler.END
         
     if update.message.text == "Да, все верно":
-        keyboard = [
-            [KeyboardButton("Поиск")],
-            [KeyboardButton("Настройки")],
-        ]
-        
-        if user_id in ADMIN_USER_IDS:
-            keyboard.append([KeyboardButton("⚙️ Админка")])
-            
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = main_menu_markup(user_id)
         
-        await update.message.reply_text(
+        await reply_text(update,
             "Твой профиль успешно создан! Теперь ты можешь начать поиск.",
             reply_markup=reply_markup,
         )
@@ -1332,7 +3796,7 @@ async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     elif update.message.text == "Изменить":
         return await settings(update, context)
     else:
-        await update.message.reply_text("Пожалуйста, выбери 'Да, все верно' или 'Изменить'.")
+        await reply_text(update, "Пожалуйста, выбери 'Да, все верно' или 'Изменить'.")
         return CONFIRMATION
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1348,24 +3812,18 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         
     text = update.message.text
     
-    keyboard = [
-        [KeyboardButton("Поиск")],
-        [KeyboardButton("Настройки")],
-    ]
-    
-    if user_id in ADMIN_USER_IDS:
-        keyboard.append([KeyboardButton("⚙️ Админка")])
-    
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    reply_markup = main_menu_markup(user_id)
     
     if text == "Поиск":
         return await search_profile(update, context)
+    elif text == "💌 Меня лайкнули":
+        return await show_inbox(update, context)
     elif text == "Настройки":
         return await settings(update, context)
     elif text == "⚙️ Админка" and user_id in ADMIN_USER_IDS:
         return await admin_panel(update, context)
     else:
-        await update.message.reply_text("Пожалуйста, выберите действие:", reply_markup=reply_markup)
+        await reply_text(update, "Пожалуйста, выберите действие:", reply_markup=reply_markup)
         return MENU
 
 # --- ФУНКЦИИ РЕДАКТИРОВАНИЯ ПРОФИЛЯ ---
@@ -1386,7 +3844,7 @@ async def edit_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         [KeyboardButton("Готово")],
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Что вы хотите изменить?", reply_markup=reply_markup)
+    await reply_text(update, "Что вы хотите изменить?", reply_markup=reply_markup)
     return EDIT_PROFILE
 
 @auto_save
@@ -1403,7 +3861,7 @@ async def edit_gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         
     keyboard = [["Мужской"], ["Женский"], ["Другое"]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text("Укажите новый пол:", reply_markup=reply_markup)
+    await reply_text(update, "Укажите новый пол:", reply_markup=reply_markup)
     return EDIT_GENDER
 
 @auto_save
@@ -1419,8 +3877,8 @@ async def save_edit_gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return ConversationHandler.END
         
     user_profiles[user_id]["gender"] = update.message.text
-    db.save_user(user_id, user_profiles[user_id])
-    await update.message.reply_text("Пол обновлен.")
+    await save_profile(user_id)
+    await reply_text(update, "Пол обновлен.")
     return await edit_profile(update, context)
 
 @auto_save
@@ -1435,7 +3893,7 @@ async def edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if await check_maintenance(update, context, user_id):
         return ConversationHandler.END
         
-    await update.message.reply_text("Укажите новое имя:")
+    await reply_text(update, "Укажите новое имя:")
     return EDIT_NAME
 
 @auto_save
@@ -1451,8 +3909,8 @@ async def save_edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
         
     user_profiles[user_id]["name"] = update.message.text
-    db.save_user(user_id, user_profiles[user_id])
-    await update.message.reply_text("Имя обновлено.")
+    await save_profile(user_id)
+    await reply_text(update, "Имя обновлено.")
     return await edit_profile(update, context)
 
 @auto_save
@@ -1467,7 +3925,7 @@ async def edit_age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if await check_maintenance(update, context, user_id):
         return ConversationHandler.END
         
-    await update.message.reply_text("Укажите новый возраст (от 16 до 25):")
+    await reply_text(update, "Укажите новый возраст (от 16 до 25):")
     return EDIT_AGE
 
 @auto_save
@@ -1485,14 +3943,14 @@ async def save_edit_age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     try:
         age = int(update.message.text)
         if age < 16 or age > 25:
-            await update.message.reply_text("Пожалуйста, укажите реальный возраст (16-25):")
+            await reply_text(update, "Пожалуйста, укажите реальный возраст (16-25):")
             return EDIT_AGE
         user_profiles[user_id]["age"] = age
-        db.save_user(user_id, user_profiles[user_id])
-        await update.message.reply_text("Возраст обновлен.")
+        await save_profile(user_id)
+        await reply_text(update, "Возраст обновлен.")
         return await edit_profile(update, context)
     except ValueError:
-        await update.message.reply_text("Пожалуйста, укажите возраст цифрами.")
+        await reply_text(update, "Пожалуйста, укажите возраст цифрами.")
         return EDIT_AGE
 
 @auto_save
@@ -1507,7 +3965,7 @@ async def edit_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if await check_maintenance(update, context, user_id):
         return ConversationHandler.END
         
-    await update.message.reply_text("Укажите новый курс (от 1 до 5):")
+    await reply_text(update, "Укажите новый курс (от 1 до 5):")
     return EDIT_CITY
 
 @auto_save
@@ -1525,14 +3983,14 @@ async def save_edit_city(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         course = int(update.message.text)
         if course < 1 or course > 5:
-            await update.message.reply_text("Пожалуйста, укажите реальный курс (1-5):")
+            await reply_text(update, "Пожалуйста, укажите реальный курс (1-5):")
             return EDIT_CITY
         user_profiles[user_id]["city"] = course
-        db.save_user(user_id, user_profiles[user_id])
-        await update.message.reply_text("Курс обновлен.")
+        await save_profile(user_id)
+        await reply_text(update, "Курс обновлен.")
         return await edit_profile(update, context)
     except ValueError:
-        await update.message.reply_text("Пожалуйста, укажите курс цифрами (1-5).")
+        await reply_text(update, "Пожалуйста, укажите курс цифрами (1-5).")
         return EDIT_CITY
 
 @auto_save
@@ -1547,7 +4005,7 @@ async def edit_bio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if await check_maintenance(update, context, user_id):
         return ConversationHandler.END
         
-    await update.message.reply_text("Напишите новое описание о себе:")
+    await reply_text(update, "Напишите новое описание о себе:")
     return EDIT_BIO
 
 @auto_save
@@ -1563,8 +4021,8 @@ async def save_edit_bio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         return ConversationHandler.END
         
     user_profiles[user_id]["bio"] = update.message.text
-    db.save_user(user_id, user_profiles[user_id])
-    await update.message.reply_text("Описание обновлено.")
+    await save_profile(user_id)
+    await reply_text(update, "Описание обновлено.")
     return await edit_profile(update, context)
 
 @auto_save
@@ -1579,7 +4037,7 @@ async def edit_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if await check_maintenance(update, context, user_id):
         return ConversationHandler.END
         
-    await update.message.reply_text("Отправьте новую фотографию:")
+    await reply_text(update, "Отправьте новую фотографию:")
     return EDIT_PHOTO
 
 @auto_save
@@ -1597,11 +4055,11 @@ async def save_edit_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if update.message.photo:
         photo_file_id = update.message.photo[-1].file_id
         user_profiles[user_id]["photo"] = photo_file_id
-        db.save_user(user_id, user_profiles[user_id])
-        await update.message.reply_text("Фотография обновлена.")
+        await save_profile(user_id)
+        await reply_text(update, "Фотография обновлена.")
         return await edit_profile(update, context)
     else:
-        await update.message.reply_text("Пожалуйста, отправьте фотографию.")
+        await reply_text(update, "Пожалуйста, отправьте фотографию.")
         return EDIT_PHOTO
 
 async def done_editing(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1615,7 +4073,7 @@ async def done_editing(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     if await check_maintenance(update, context, user_id):
         return ConversationHandler.END
         
-    await update.message.reply_text("Изменения сохранены.", reply_markup=ReplyKeyboardRemove())
+    await reply_text(update, "Изменения сохранены.", reply_markup=ReplyKeyboardRemove())
     return await settings(update, context)
 
 async def show_my_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1630,7 +4088,7 @@ async def show_my_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
         
     if not is_profile_complete(user_id):
-        await update.message.reply_text("Ваш профиль еще не заполнен.")
+        await reply_text(update, "Ваш профиль еще не заполнен.")
         return MENU
 
     profile = user_profiles[user_id]
@@ -1651,14 +4109,15 @@ async def show_my_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
     if profile.get("photo"):
-        await context.bot.send_photo(
+        await dispatcher.send(
+            'send_photo',
             chat_id=user_id,
             photo=profile["photo"],
             caption=message_text,
             reply_markup=reply_markup
         )
     else:
-        await update.message.reply_text(
+        await reply_text(update,
             message_text + "\n(Фото отсутствует)",
             reply_markup=reply_markup
         )
@@ -1682,51 +4141,24 @@ async def search_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if 'viewed_profiles' not in user_data:
         user_data['viewed_profiles'] = []
     
-    viewed_profiles = user_data['viewed_profiles']
-    available_profiles = []
-
-    for profile_id, profile_data in user_profiles.items():
-        if profile_id == user_id:
-            continue
-        if profile_id in user_likes.get(user_id, set()):
-            continue
-        if profile_id in user_dislikes.get(user_id, set()):
-            continue
-        if profile_id in matched_users.get(user_id, set()):
-            continue
-        if not is_profile_complete(profile_id):
-            continue
-        # Пропускаем забаненных пользователей
-        if db.is_user_banned(profile_id):
-            continue
-
-        available_profiles.append(profile_id)
-
-    if not available_profiles:
+    is_excluded = search_exclusion(user_id)
+    
+    # Обычно анкета уже ждет в колоде; если колоды еще нет - выбираем на месте,
+    # а колоду соберет фоновая задача
+    next_profile_id = swipe_decks.pop(user_id, is_excluded)
+    if next_profile_id is None:
+        # Индекс уже содержит только заполненные анкеты незабаненных
+        next_profile_id = pick_candidate(user_id, is_excluded)
+    
+    if next_profile_id is None:
         user_data['viewed_profiles'] = []
-        available_profiles = [pid for pid in user_profiles.keys() 
-                            if pid != user_id 
-                            and is_profile_complete(pid)
-                            and pid not in user_likes.get(user_id, set())
-                            and pid not in user_dislikes.get(user_id, set())
-                            and pid not in matched_users.get(user_id, set())
-                            and not db.is_user_banned(pid)]  # Исключаем забаненных
-        
-        if not available_profiles:
-            keyboard = [
-                [KeyboardButton("Поиск")],
-                [KeyboardButton("Настройки")],
-            ]
-            if user_id in ADMIN_USER_IDS:
-                keyboard.append([KeyboardButton("⚙️ Админка")])
-                
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
-            await update.message.reply_text("Пока что больше нет анкет. Попробуйте позже!",
-                                            reply_markup=reply_markup)
-            return MENU
+        
+        reply_markup = main_menu_markup(user_id)
+        
+        await reply_text(update, "Пока что больше нет анкет. Попробуйте позже!",
+                                        reply_markup=reply_markup)
+        return MENU
 
-    next_profile_id = random.choice(available_profiles)
     context.user_data['current_viewing_profile_id'] = next_profile_id
 
     keyboard = [
@@ -1738,16 +4170,25 @@ async def search_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await send_profile_card(user_id, next_profile_id, context, reply_markup)
     return SEARCH
 
-# --- Notification functions ---
-@auto_save
-async def notify_liked_user(liker_id: int, liked_id: int, context: ContextTypes.DEFAULT_TYPE):
-    # Проверяем бан для уведомлений
-    if await check_maintenance_for_user(liked_id) or db.is_user_banned(liked_id):
-        return
-        
-    liker_profile = user_profiles.get(liker_id)
-    if not liker_profile:
-        logger.error(f"Liker profile not found for ID: {liker_id}")
+# --- ОЧЕРЕДЬ УВЕДОМЛЕНИЙ (OUTBOX) ---
+# Сколько уведомлений забирать из outbox за раз
+OUTBOX_BATCH = 20
+# На сколько секунд взятая строка скрыта от повторного забора (страховка от падения посреди отправки)
+OUTBOX_LEASE = 120
+# Экспоненциальная пауза между попытками: BASE, 2*BASE, 4*BASE ... не больше MAX (секунды)
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_MAX = 3600
+# После стольких неудачных попыток строка уходит в dead-letter
+OUTBOX_MAX_ATTEMPTS = 8
+# На сколько откладывать уведомления, пока у получателя техобслуживание (секунды)
+OUTBOX_MAINTENANCE_DELAY = 300
+# Как часто будить разборщик на случай строк, записанных другим процессом (секунды)
+OUTBOX_POLL_INTERVAL = 30
+
+async def deliver_like_notification(liked_id, liker_id):
+    """Уведомление о лайке: анкета лайкнувшего с кнопками ответа"""
+    if not user_profiles.get(liker_id):
+        logger.warning(f"Liker profile not found for ID: {liker_id}, notification dropped")
         return
 
     keyboard = [
@@ -1756,52 +4197,139 @@ async def notify_liked_user(liker_id: int, liked_id: int, context: ContextTypes.
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await context.bot.send_message(
-        chat_id=liked_id,
-        text="Тебя лайкнули! Вот чья анкета:",
-        reply_markup=ReplyKeyboardRemove()
-    )
-    await send_profile_card(liked_id, liker_id, context, reply_markup)
+    # Заголовок - в самой анкете: одна строка outbox = одно сообщение,
+    # и повтор после ошибки не пришлет заголовок второй раз
+    await send_profile_card(liked_id, liker_id, None, reply_markup, PRIORITY_NOTIFICATION,
+                            header="Тебя лайкнули! Вот чья анкета:")
 
-@auto_save
-async def notify_match(user1_id: int, user2_id: int, context: ContextTypes.DEFAULT_TYPE):
-    # Проверяем бан для уведомлений
-    if (await check_maintenance_for_user(user1_id) or db.is_user_banned(user1_id) or
-        await check_maintenance_for_user(user2_id) or db.is_user_banned(user2_id)):
+async def deliver_match_notification(user_id, other_id):
+    """Уведомление о совпадении с контактом второй стороны"""
+    other_profile = user_profiles.get(other_id)
+    if not other_profile:
+        logger.warning(f"Matched profile not found for ID: {other_id}, notification dropped")
         return
-        
-    user1_profile = user_profiles.get(user1_id)
-    user2_profile = user_profiles.get(user2_id)
 
-    if not user1_profile or not user2_profile:
-        logger.error(f"One of the matched profiles not found: {user1_id}, {user2_id}")
-        return
-
-    user1_username = user1_profile.get('username', 'Неизвестный пользователь')
-    user2_username = user2_profile.get('username', 'Неизвестный пользователь')
-
-    match_message_for_user1 = (
-        f"🎉 У тебя совпадение с {user2_profile['name']}! "
-        f"Его/её Telegram: @{user2_username}"
-    )
-    match_message_for_user2 = (
-        f"🎉 У тебя совпадение с {user1_profile['name']}! "
-        f"Его/её Telegram: @{user1_username}"
+    other_username = other_profile.get('username', 'Неизвестный пользователь')
+    await dispatcher.send(
+        'send_message',
+        PRIORITY_NOTIFICATION,
+        chat_id=user_id,
+        text=f"🎉 У тебя совпадение с {other_profile['name']}! Его/её Telegram: @{other_username}"
     )
 
-    await context.bot.send_message(chat_id=user1_id, text=match_message_for_user1)
-    await context.bot.send_message(chat_id=user2_id, text=match_message_for_user2)
-
-    if user1_id not in matched_users:
-        matched_users[user1_id] = set()
-    matched_users[user1_id].add(user2_id)
-
-    if user2_id not in matched_users:
-        matched_users[user2_id] = set()
-    matched_users[user2_id].add(user1_id)
-    
-    # Сохраняем в БД
-    db.add_match(user1_id, user2_id)
+OUTBOX_DELIVERERS = {
+    OUTBOX_LIKE: deliver_like_notification,
+    OUTBOX_MATCH: deliver_match_notification,
+}
+
+class OutboxDrainer:
+    """Фоновая доставка уведомлений из таблицы outbox.
+    
+    Строки пишутся в одной транзакции с лайком или совпадением, поэтому
+    уведомление не теряется ни при ошибке отправки, ни при перезапуске.
+    Доставленные строки удаляются; при ошибке - повтор с экспоненциальной
+    паузой, на RetryAfter - повтор через указанное Telegram время без счета
+    попытки. Постоянные ошибки (бот заблокирован, чат не найден) и исчерпанные
+    попытки переводят строку в dead-letter (status = 'dead').
+    """
+    
+    def __init__(self):
+        self._task = None
+        self._wakeup = None
+        
+        # Метрики
+        self.delivered = 0
+        self.retried = 0
+        self.retry_after = 0
+        self.dead = 0
+    
+    def wake(self):
+        """Будит разборщик (запускает, если еще не работает)"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = OUTBOX_POLL_INTERVAL
+            try:
+                rows = await adb.claim_outbox(OUTBOX_BATCH, OUTBOX_LEASE, SHARD_COUNT, SHARD_INDEX or 0)
+                if rows:
+                    await self._deliver_batch(rows)
+                    continue
+                next_due = await adb.next_outbox_due()
+                if next_due is not None:
+                    timeout = min(timeout, max(0.0, next_due - time.time()))
+            except Exception as e:
+                logger.error(f"Outbox drain failed: {e}")
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _deliver_batch(self, rows):
+        # Отправляем пачку параллельно: лимиты соблюдает диспетчер
+        outcomes = await asyncio.gather(*(self._deliver(*row) for row in rows))
+        delivered, retries, dead = [], [], []
+        for outbox_id, attempts, next_attempt_at, error in outcomes:
+            if error is None:
+                delivered.append(outbox_id)
+            elif next_attempt_at is None:
+                dead.append((attempts, error, outbox_id))
+            else:
+                retries.append((attempts, next_attempt_at, error, outbox_id))
+        await adb.settle_outbox(delivered, retries, dead)
+        self.delivered += len(delivered)
+        self.retried += len(retries)
+        self.dead += len(dead)
+    
+    async def _deliver(self, outbox_id, chat_id, kind, subject_id, attempts):
+        """Одна попытка доставки: (id, attempts, next_attempt_at, error); error None - доставлено"""
+        # Забаненным уведомления не шлем, и о забаненных тоже
+        if ban_registry.is_banned(chat_id) or ban_registry.is_banned(subject_id):
+            return outbox_id, attempts, None, None
+        if await check_maintenance_for_user(chat_id):
+            return outbox_id, attempts, time.time() + OUTBOX_MAINTENANCE_DELAY, "maintenance"
+        
+        deliverer = OUTBOX_DELIVERERS.get(kind)
+        if deliverer is None:
+            return outbox_id, attempts, None, f"unknown kind {kind}"
+        
+        try:
+            await deliverer(chat_id, subject_id)
+        except RetryAfter as e:
+            self.retry_after += 1
+            return outbox_id, attempts, time.time() + retry_after_seconds(e), str(e)
+        except (Forbidden, BadRequest) as e:
+            logger.warning(f"Outbox {kind} notification to {chat_id} is undeliverable: {e}")
+            return outbox_id, attempts + 1, None, str(e)
+        except Exception as e:
+            attempts += 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Outbox {kind} notification to {chat_id} failed {attempts} times, dead-lettered: {e}")
+                return outbox_id, attempts, None, str(e)
+            delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+            # Небольшой разброс, чтобы отложенные строки не возвращались одной пачкой
+            return outbox_id, attempts, time.time() + delay * random.uniform(1.0, 1.2), str(e)
+        return outbox_id, attempts, None, None
+    
+    def get_metrics(self):
+        """Метрики для админки"""
+        return {
+            'delivered': self.delivered,
+            'retried': self.retried,
+            'retry_after': self.retry_after,
+            'dead': self.dead,
+        }
+
+outbox = OutboxDrainer()
+
+async def drain_outbox_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически будит разборщик outbox (после старта и для строк других процессов)"""
+    outbox.wake()
 
 @auto_save
 async def like(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1820,25 +4348,14 @@ async def like(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_data = context.user_data
 
     if not liked_id:
-        keyboard = [
-            [KeyboardButton("Поиск")],
-            [KeyboardButton("Настройки")],
-        ]
-        if liker_id in ADMIN_USER_IDS:
-            keyboard.append([KeyboardButton("⚙️ Админка")])
-            
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = main_menu_markup(liker_id)
         
-        await update.message.reply_text("Что-то пошло не так. Попробуйте снова начать поиск.",
+        await reply_text(update, "Что-то пошло не так. Попробуйте снова начать поиск.",
                                         reply_markup=reply_markup)
         return MENU
 
-    if liker_id not in user_likes:
-        user_likes[liker_id] = set()
-    user_likes[liker_id].add(liked_id)
-    
-    # Сохраняем в БД
-    db.add_like(liker_id, liked_id)
+    # Лайк, проверка взаимности и совпадение - одна транзакция в БД
+    new_match = await record_like(liker_id, liked_id, context)
 
     if 'viewed_profiles' not in user_data:
         user_data['viewed_profiles'] = []
@@ -1847,13 +4364,11 @@ async def like(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     clear_old_viewed_profiles(user_data)
 
-    if liked_id in user_likes and liker_id in user_likes[liked_id]:
-        await notify_match(liker_id, liked_id, context)
-        await update.message.reply_text("УРА! Это совпадение! 🎉")
+    if new_match:
+        await reply_text(update, "УРА! Это совпадение! 🎉")
         return await search_profile(update, context)
     else:
-        await notify_liked_user(liker_id, liked_id, context)
-        await update.message.reply_text("Лайк отправлен! Продолжаем поиск...")
+        await reply_text(update, "Лайк отправлен! Продолжаем поиск...")
         return await search_profile(update, context)
 
 @auto_save
@@ -1873,22 +4388,18 @@ async def dislike(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_data = context.user_data
 
     if not disliked_id:
-        keyboard = [
-            [KeyboardButton("Поиск")],
-            [KeyboardButton("Настройки")],
-        ]
-        if disliker_id in ADMIN_USER_IDS:
-            keyboard.append([KeyboardButton("⚙️ Админка")])
-            
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = main_menu_markup(disliker_id)
         
-        await update.message.reply_text("Что-то пошло не так. Попробуйте снова начать поиск.",
+        await reply_text(update, "Что-то пошло не так. Попробуйте снова начать поиск.",
                                         reply_markup=reply_markup)
         return MENU
 
     if disliker_id not in user_dislikes:
-        user_dislikes[disliker_id] = set()
+        user_dislikes[disliker_id] = IdSet()
     user_dislikes[disliker_id].add(disliked_id)
+    
+    # Сохраняем в БД
+    await adb.add_dislike(disliker_id, disliked_id)
 
     if 'viewed_profiles' not in user_data:
         user_data['viewed_profiles'] = []
@@ -1897,7 +4408,7 @@ async def dislike(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     clear_old_viewed_profiles(user_data)
 
-    await update.message.reply_text("Анкета пропущена. Продолжаем поиск...")
+    await reply_text(update, "Анкета пропущена. Продолжаем поиск...")
     return await search_profile(update, context)
 
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1918,9 +4429,141 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         [KeyboardButton("⬅️ Меню")],
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Настройки:", reply_markup=reply_markup)
+    await reply_text(update, "Настройки:", reply_markup=reply_markup)
     return SETTINGS
 
+# --- ВХОДЯЩИЕ ЛАЙКИ ---
+# Сколько лайкнувших показывать на одной странице
+INBOX_PAGE_SIZE = 5
+
+def pending_likers(user_id):
+    """Кто лайкнул пользователя и еще ждет ответа, новые id первыми"""
+    liked = user_likes.get(user_id, ())
+    disliked = user_dislikes.get(user_id, ())
+    matched = matched_users.get(user_id, ())
+    return sorted(
+        (liker_id for liker_id in user_liked_by.get(user_id, ())
+         if liker_id not in liked and liker_id not in disliked and liker_id not in matched
+         and liker_id in user_profiles and not ban_registry.is_banned(liker_id)),
+        reverse=True
+    )
+
+def render_inbox_page(user_id, user_data, page):
+    """Текст и кнопки страницы входящих лайков. Запоминает, кто на ней показан"""
+    pending = pending_likers(user_id)
+    if not pending:
+        user_data.pop('inbox_page_ids', None)
+        return "Пока никто не ждет твоего ответа. Загляни позже!", None
+    
+    pages = (len(pending) + INBOX_PAGE_SIZE - 1) // INBOX_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    shown = pending[page * INBOX_PAGE_SIZE:(page + 1) * INBOX_PAGE_SIZE]
+    # Массовые действия применяются ровно к тем, кого пользователь видел
+    user_data['inbox_page'] = page
+    user_data['inbox_page_ids'] = shown
+    
+    lines = [f"💌 Тебя лайкнули: {len(pending)} (страница {page + 1} из {pages})", ""]
+    keyboard = []
+    for liker_id in shown:
+        profile = user_profiles[liker_id]
+        title = f"{profile.get('name') or 'Без имени'}, {profile.get('age') or '?'}"
+        lines.append(f"• {title}")
+        keyboard.append([InlineKeyboardButton(f"👀 {title}", callback_data=f"inbox_view_{liker_id}")])
+    keyboard.append([
+        InlineKeyboardButton("❤️ Лайкнуть всех", callback_data=f"inbox_like_all_{page}"),
+        InlineKeyboardButton("❌ Отклонить всех", callback_data=f"inbox_reject_all_{page}"),
+    ])
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=f"inbox_page_{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=f"inbox_page_{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def show_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Показывает первую страницу входящих лайков"""
+    user_id = update.effective_user.id
+    
+    # Проверяем бан
+    if await check_ban(update, context, user_id):
+        return ConversationHandler.END
+        
+    if await check_maintenance(update, context, user_id):
+        return ConversationHandler.END
+    
+    text, reply_markup = render_inbox_page(user_id, context.user_data, 0)
+    await reply_text(update, text, reply_markup=reply_markup)
+    return MENU
+
+@auto_save
+async def handle_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопки страницы входящих лайков: листание, просмотр, лайк/отказ всем"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = query.from_user.id
+    if await check_maintenance_for_user(user_id) or ban_registry.is_banned(user_id):
+        await edit_query_text(query, "⚙️ Бот находится на техническом обслуживании. Пожалуйста, попробуйте позже.")
+        return
+    
+    action, _, argument = query.data[len("inbox_"):].rpartition("_")
+    try:
+        argument = int(argument)
+    except ValueError:
+        logger.error(f"Invalid inbox callback data: {query.data}")
+        return
+    
+    user_data = context.user_data
+    
+    if action == "view":
+        if argument not in user_liked_by.get(user_id, ()) or argument not in user_profiles:
+            await dispatcher.send('send_message', chat_id=user_id, text="Эта анкета больше недоступна.")
+            return
+        keyboard = [
+            [InlineKeyboardButton("❤️ Лайкнуть в ответ", callback_data=f"like_back_{argument}")],
+            [InlineKeyboardButton("❌ Отклонить", callback_data=f"dislike_back_{argument}")]
+        ]
+        await send_profile_card(user_id, argument, context, InlineKeyboardMarkup(keyboard))
+        return
+    
+    notice = ""
+    if action in ("like_all", "reject_all"):
+        # Кнопка со старой страницы: список уже другой, ничего не делаем
+        if user_data.get('inbox_page') != argument:
+            notice = "Список обновился, проверь его еще раз."
+        else:
+            pending = set(pending_likers(user_id))
+            targets = [liker_id for liker_id in user_data.get('inbox_page_ids', []) if liker_id in pending]
+            # Не каждый лайк дает совпадение: встречный лайк могли уже удалить (/clear, /reset)
+            new_matches = 0
+            for liker_id in targets:
+                if action == "like_all":
+                    if await record_like(user_id, liker_id, context):
+                        new_matches += 1
+                else:
+                    if user_id not in user_dislikes:
+                        user_dislikes[user_id] = IdSet()
+                    user_dislikes[user_id].add(liker_id)
+                    await adb.add_dislike(user_id, liker_id)
+            if action == "like_all":
+                notice = f"🎉 Новых совпадений: {new_matches}"
+            else:
+                notice = f"Отклонено анкет: {len(targets)}"
+    elif action != "page":
+        logger.error(f"Unknown inbox action: {query.data}")
+        return
+    
+    text, reply_markup = render_inbox_page(user_id, user_data, argument)
+    if notice:
+        text = f"{notice}\n\n{text}"
+    try:
+        await edit_query_text(query, text=text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.warning(f"Could not edit inbox message, sending new one: {e}")
+        await dispatcher.send('send_message', chat_id=user_id, text=text, reply_markup=reply_markup)
+
 # --- CallbackQueryHandler for InlineKeyboardButtons ---
 @auto_save
 async def handle_match_response(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1930,8 +4573,8 @@ async def handle_match_response(update: Update, context: ContextTypes.DEFAULT_TY
     liked_id = query.from_user.id
     
     # Проверяем бан для callback
-    if await check_maintenance_for_user(liked_id) or db.is_user_banned(liked_id):
-        await query.edit_message_text("⚙️ Бот находится на техническом обслуживании. Пожалуйста, попробуйте позже.")
+    if await check_maintenance_for_user(liked_id) or ban_registry.is_banned(liked_id):
+        await edit_query_text(query, "⚙️ Бот находится на техническом обслуживании. Пожалуйста, попробуйте позже.")
         return
 
     callback_data = query.data
@@ -1954,55 +4597,55 @@ async def handle_match_response(update: Update, context: ContextTypes.DEFAULT_TY
 
     try:
         if action == "like_back":
-            if liked_id not in user_likes:
-                user_likes[liked_id] = set()
-            user_likes[liked_id].add(liker_id)
-            
-            # Сохраняем в БД
-            db.add_like(liked_id, liker_id)
-
-            await notify_match(liker_id, liked_id, context)
+            # Тот же путь, что и в like(): совпадение решает транзакция в БД,
+            # поэтому повторное нажатие кнопки не уведомит еще раз
+            if await record_like(liked_id, liker_id, context):
+                response_text = "УРА! Это совпадение! 🎉"
+            elif liker_id in matched_users.get(liked_id, ()):
+                response_text = "Вы уже совпали! 🎉"
+            else:
+                response_text = "Лайк отправлен!"
             try:
-                await query.edit_message_text(text="УРА! Это совпадение! 🎉")
+                await edit_query_text(query, text=response_text)
             except Exception as e:
                 logger.warning(f"Could not edit message, sending new one: {e}")
-                await context.bot.send_message(
+                await dispatcher.send(
+                    'send_message',
                     chat_id=liked_id,
-                    text="УРА! Это совпадение! 🎉"
+                    text=response_text
                 )
         elif action == "dislike_back":
             if liked_id not in user_dislikes:
-                user_dislikes[liked_id] = set()
+                user_dislikes[liked_id] = IdSet()
             user_dislikes[liked_id].add(liker_id)
             
+            # Сохраняем в БД
+            await adb.add_dislike(liked_id, liker_id)
+            
             try:
-                await query.edit_message_text(text="Анкета отклонена.")
+                await edit_query_text(query, text="Анкета отклонена.")
             except Exception as e:
                 logger.warning(f"Could not edit message, sending new one: {e}")
-                await context.bot.send_message(
+                await dispatcher.send(
+                    'send_message',
                     chat_id=liked_id,
                     text="Анкета отклонена."
                 )
 
     except Exception as e:
         logger.error(f"Error in handle_match_response: {e}")
-        await context.bot.send_message(
+        await dispatcher.send(
+            'send_message',
             chat_id=liked_id,
             text="Произошла ошибка при обработке вашего ответа."
         )
 
     user_id = liked_id
-    keyboard = [
-        [KeyboardButton("Поиск")],
-        [KeyboardButton("Настройки")],
-    ]
-    if user_id in ADMIN_USER_IDS:
-        keyboard.append([KeyboardButton("⚙️ Админка")])
-    
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    reply_markup = main_menu_markup(user_id)
     
     try:
-        await context.bot.send_message(
+        await dispatcher.send(
+            'send_message',
             chat_id=liked_id,
             text="Что дальше?",
             reply_markup=reply_markup
@@ -2010,8 +4653,22 @@ async def handle_match_response(update: Update, context: ContextTypes.DEFAULT_TY
     except Exception as e:
         logger.error(f"Error sending menu message: {e}")
 
+# Флаги ожидания ввода в админке и данные начатого бана: при отмене сбрасываются
+ADMIN_PENDING_INPUT_KEYS = (
+    'waiting_for_maintenance_message',
+    'waiting_for_maintenance_end',
+    'waiting_for_ban_user_id',
+    'waiting_for_ban_reason',
+    'waiting_for_unban',
+    'ban_target_id',
+    'ban_target_username',
+)
+
 async def back_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Возврат в админ панель"""
+    # Иначе следующий текст админа уйдет в брошенный ввод (сообщение, бан, ...)
+    for key in ADMIN_PENDING_INPUT_KEYS:
+        context.user_data.pop(key, None)
     return await admin_panel(update, context)
 
 async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -2025,39 +4682,583 @@ async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     if await check_maintenance(update, context, user_id):
         return ConversationHandler.END
         
-    keyboard = [
-        [KeyboardButton("Поиск")],
-        [KeyboardButton("Настройки")],
-    ]
-    
-    if user_id in ADMIN_USER_IDS:
-        keyboard.append([KeyboardButton("⚙️ Админка")])
-    
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Возвращаемся в меню.", reply_markup=reply_markup)
+    reply_markup = main_menu_markup(user_id)
+    await reply_text(update, "Возвращаемся в меню.", reply_markup=reply_markup)
     return MENU
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels the current conversation."""
     user = update.message.from_user
     logger.info("User %s canceled the conversation.", user.first_name)
-    await update.message.reply_text(
+    await reply_text(update,
         "До свидания! Надеюсь, мы еще пообщаемся.", reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
 
-def main() -> None:
-    """Run the bot."""
-    # 🔥 ПРОВЕРЯЕМ И СОЗДАЕМ БАЗУ ДАННЫХ ПРИ СТАРТЕ
-    if not os.path.exists(DB_FILE):
-        print("🆕 Создаю базу данных...")
-        db.init_db()
+# --- ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ---
+# Сколько обработчиков (разных пользователей) выполняются одновременно
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Сколько обновлений может быть принято в работу всего, включая ждущие своей очереди
+UPDATES_IN_FLIGHT_LIMIT = 4096
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с очередностью внутри одного пользователя.
+    
+    Обновления разных пользователей обрабатываются одновременно, поэтому
+    медленная отправка фото одному не задерживает остальных. Обновления
+    одного пользователя идут строго по порядку под его asyncio.Lock (FIFO):
+    его user_data, состояние диалога и анкета меняются последовательно.
+    Общие словари (user_profiles, user_likes, matched_users ...) меняются
+    только из event loop и без await посреди изменения, так что отдельные
+    блокировки им не нужны.
+    
+    Ждущие своей очереди обновления не занимают слоты CONCURRENT_UPDATES:
+    один пользователь, нажимающий кнопки подряд, не блокирует остальных.
+    """
+    
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES):
+        super().__init__(UPDATES_IN_FLIGHT_LIMIT)
+        self._active = asyncio.Semaphore(max_concurrent_updates)
+        # ключ -> [asyncio.Lock, сколько обновлений его держат или ждут]
+        self._locks = {}
+    
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._active:
+                await coroutine
+            return
+        
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._active:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# --- ХРАНЕНИЕ СЕССИЙ ---
+# Как часто PTB отдает накопившиеся изменения user_data и диалогов на запись (секунды)
+PERSISTENCE_UPDATE_INTERVAL = 30
+# Имя ConversationHandler в таблице conversations
+CONVERSATION_NAME = "main"
+
+class SQLitePersistence(BasePersistence):
+    """Хранит user_data и состояния ConversationHandler в bot_database.db.
+    
+    Пишутся только изменившиеся записи: PTB раз в PERSISTENCE_UPDATE_INTERVAL
+    отдает пользователей, у которых были обновления, а из них сохраняются
+    только те, чьи данные отличаются от последнего записанного JSON.
+    Записи идут через очередь отложенной записи - одной транзакцией на пачку.
+    
+    user_data загружается лениво, при первом обновлении пользователя
+    (refresh_user_data), так что старт не зависит от числа сессий.
+    Состояния диалогов ConversationHandler нужны ему сразу - они читаются
+    при старте, но это одно число на пользователя.
+    """
+    
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        # user_id -> JSON последнего записанного (или загруженного) user_data
+        self._saved_user_data = {}
+        self._loaded_users = set()
+    
+    # --- user_data ---
+    async def get_user_data(self):
+        # Ничего не грузим заранее: см. refresh_user_data
+        return {}
+    
+    async def refresh_user_data(self, user_id, user_data):
+        """Вызывается PTB перед обработкой каждого обновления пользователя"""
+        if user_id in self._loaded_users:
+            return
+        try:
+            data = await adb.get_session(user_id)
+        except Exception as e:
+            # Не помечаем загруженным: попробуем при следующем обновлении
+            logger.error(f"Failed to load session of {user_id}: {e}")
+            return
+        self._loaded_users.add(user_id)
+        if data is None:
+            return
+        # То, что уже успели записать в этом обновлении, свежее сохраненного
+        for key, value in json.loads(data).items():
+            user_data.setdefault(key, value)
+        self._saved_user_data[user_id] = data
+    
+    async def update_user_data(self, user_id, data):
+        if user_id not in self._loaded_users:
+            return  # Сессия не загружена - не затираем сохраненную
+        if not data:
+            if self._saved_user_data.pop(user_id, None) is not None:
+                await adb.drop_session(user_id)
+            return
+        serialized = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        if self._saved_user_data.get(user_id) == serialized:
+            return
+        self._saved_user_data[user_id] = serialized
+        await adb.save_session(user_id, serialized)
+    
+    async def drop_user_data(self, user_id):
+        self._saved_user_data.pop(user_id, None)
+        await adb.drop_session(user_id)
+    
+    # --- Диалоги ---
+    async def get_conversations(self, name):
+        return {
+            tuple(json.loads(key)): state
+            for key, state in await adb.get_conversations(name)
+        }
+    
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await adb.end_conversation(name, json.dumps(key))
+        else:
+            await adb.save_conversation(name, json.dumps(key), new_state)
+    
+    async def flush(self):
+        """Вызывается PTB при остановке после последних update_*"""
+        await adb.flush_writes()
+    
+    # --- Не храним: chat_data, bot_data, callback_data выключены в store_data ---
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# --- ВЕБХУК ---
+# Режим получения обновлений: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, который Telegram будет вызывать (https://example.com/telegram)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Локальный адрес, на котором слушает HTTP-сервер вебхука
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+# Путь, на который приходят обновления; /healthz - проверка живости (см. HEALTH_PORT)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+HEALTH_PATH = "/healthz"
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token; если не задан - случайный на каждый запуск
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Адрес Bot API (для тестов с локальным фейковым API), без /bot<token>
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+# Порт отдельного сервера GET /healthz в режиме вебхука (0 - не запускать).
+# Воркеры отвечают на /healthz на порту своего вебхука: его ждет фронт
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "0"))
+
+def health_status(application, started_at):
+    """Состояние бота для /healthz"""
+    return {
+        "ok": True,
+        "mode": "worker" if SHARD_INDEX is not None else BOT_MODE,
+        "uptime": round(time.time() - started_at),
+        "update_queue": application.update_queue.qsize(),
+        "outgoing_queue": dispatcher.depth,
+    }
+
+class HealthHandler(tornado.web.RequestHandler):
+    """GET /healthz"""
     
-    # Загружаем данные при старте
-    load_data()
-    startup_notice()
-    setup_data_persistence()
+    def initialize(self, bot_application, started_at):
+        self.bot_application = bot_application
+        self.started_at = started_at
+    
+    def get(self):
+        self.write(health_status(self.bot_application, self.started_at))
+
+def health_route(application):
+    """Маршрут /healthz для tornado.web.Application"""
+    return (HEALTH_PATH, HealthHandler, {"bot_application": application, "started_at": time.time()})
+
+class HealthServer:
+    """Отдельный маленький HTTP-сервер с одним GET /healthz.
     
+    Вебхук обслуживает сам PTB (Application.run_webhook), добавить в его
+    сервер свой путь нельзя - поэтому проверка живости на своем порту.
+    """
+    
+    def __init__(self, application, listen=WEBHOOK_LISTEN, port=HEALTH_PORT):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self._server = None
+    
+    async def start(self):
+        self._server = HTTPServer(tornado.web.Application([health_route(self.application)]))
+        self._server.listen(self.port, address=self.listen)
+        logger.info(f"Health endpoint listening on {self.listen}:{self.port}{HEALTH_PATH}")
+    
+    async def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
+
+def run_webhook(application):
+    """Запускает бота в режиме вебхука до SIGINT/SIGTERM.
+    
+    Прием обновлений, проверку секрета и set_webhook делает PTB.
+    """
+    if HEALTH_PORT:
+        health = HealthServer(application)
+        post_init, post_shutdown = application.post_init, application.post_shutdown
+        
+        async def start_with_health(app):
+            if post_init:
+                await post_init(app)
+            await health.start()
+        
+        async def stop_with_health(app):
+            await health.stop()
+            if post_shutdown:
+                await post_shutdown(app)
+        
+        application.post_init = start_with_health
+        application.post_shutdown = stop_with_health
+    
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+    )
+
+async def run_worker(application):
+    """Запускает воркера до SIGINT/SIGTERM: обновления ему пересылает фронт.
+    
+    Принимает их тем же обработчиком, что и Application.run_webhook (секрет,
+    разбор Update), но без set_webhook: адрес воркера в Telegram отобрал бы
+    вебхук у фронта. /healthz отвечает на том же порту.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    webhook_app = WebhookAppClass(WEBHOOK_PATH, application.bot, application.update_queue, WEBHOOK_SECRET)
+    webhook_app.add_handlers(r".*", [health_route(application)])
+    server = HTTPServer(webhook_app)
+    await application.initialize()
+    try:
+        # Как в run_polling: post_init после initialize, post_stop после stop, post_shutdown после shutdown
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        # Слушаем, только когда готовы обрабатывать: фронт ждет ответа /healthz
+        server.listen(WEBHOOK_PORT, address=WEBHOOK_LISTEN)
+        logger.info(f"Shard worker listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop_event.wait()
+        logger.info("Stopping shard worker")
+    finally:
+        server.stop()
+        await server.close_all_connections()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# --- ШАРДИРОВАНИЕ ПО ВОРКЕРАМ ---
+# Воркер i слушает 127.0.0.1:SHARD_BASE_PORT + i, фронт пересылает ему обновления
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8600"))
+# Как часто воркер проверяет базу на изменения других воркеров (PRAGMA data_version), секунды
+SHARD_SYNC_INTERVAL = 1
+# Пауза между повторами пересылки недоступному воркеру: 0.5, 1, 2 ... но не больше MAX (секунды)
+SHARD_FORWARD_BACKOFF = 0.5
+SHARD_FORWARD_BACKOFF_MAX = 5
+# Ответы воркера, после которых пересылку повторяем; на остальные (4xx, 500
+# от обработчика вебхука PTB на битом обновлении) обновление отбрасывается
+SHARD_RETRY_STATUSES = (502, 503, 504)
+# Сколько ждать, пока воркер при старте загрузит данные и ответит на /healthz (секунды)
+SHARD_START_TIMEOUT = 300
+# Как часто фронт проверяет, живы ли воркеры, и сколько ждать их остановки (секунды)
+SHARD_SUPERVISE_INTERVAL = 1
+SHARD_STOP_TIMEOUT = 10
+# Пауза перед перезапуском упавшего воркера: 1, 2, 4 ... но не больше MAX (секунды).
+# Если воркер до падения проработал RESET секунд, пауза снова начинается с минимальной
+SHARD_RESTART_BACKOFF = 1
+SHARD_RESTART_BACKOFF_MAX = 60
+SHARD_RESTART_BACKOFF_RESET = 60
+# Как часто фронт пишет метрики в лог (секунды)
+SHARD_METRICS_LOG_INTERVAL = 60
+
+class ShardFront:
+    """Фронт-процесс: принимает обновления и раздает их воркерам по user_id.
+    
+    Сам фронт обработчиков бота не выполняет и данных не загружает. Он
+    запускает SHARD_COUNT воркеров (тот же скрипт с SHARD_INDEX), следит,
+    чтобы они были живы, и пересылает каждое обновление воркеру его
+    пользователя на локальный вебхук. У каждого воркера своя очередь и своя
+    задача пересылки: обновления одного пользователя идут по порядку, а
+    упавший или перезапускающийся воркер задерживает только свои обновления.
+    Пока воркер недоступен, его обновления копятся в очереди, а не теряются.
+    Все сессии пользователя (user_data, диалог, колода) живут в его воркере,
+    общие данные (анкеты, лайки, совпадения, баны) - в общей базе.
+    """
+    
+    def __init__(self, count=SHARD_COUNT, base_port=SHARD_BASE_PORT):
+        self.count = count
+        self.base_port = base_port
+        # Секрет локальных вебхуков воркеров: наружу не выдается
+        self.secret = secrets.token_urlsafe(32)
+        self._workers = [None] * count
+        # Для паузы перед перезапуском: когда воркер запущен, текущая пауза
+        # и время, раньше которого упавший воркер не перезапускаем
+        self._started_at = [0.0] * count
+        self._restart_delay = [0.0] * count
+        self._restart_at = [None] * count
+        self._queues = []
+        self._tasks = []
+        self._client = None
+        
+        # Метрики
+        self.forwarded = 0
+        self.retries = 0
+        self.rejected = 0
+        self.restarts = 0
+    
+    def _url(self, index, path):
+        return f"http://127.0.0.1:{self.base_port + index}{path}"
+    
+    def _spawn(self, index):
+        env = dict(
+            os.environ,
+            SHARD_COUNT=str(self.count),
+            SHARD_INDEX=str(index),
+            BOT_MODE="worker",
+            WEBHOOK_LISTEN="127.0.0.1",
+            WEBHOOK_PORT=str(self.base_port + index),
+            WEBHOOK_SECRET=self.secret,
+        )
+        self._workers[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self._started_at[index] = time.monotonic()
+        logger.info(f"Started shard worker {index} (pid {self._workers[index].pid})")
+    
+    def _restart_if_dead(self, index):
+        """Перезапускает упавшего воркера, но не чаще, чем позволяет пауза.
+        
+        Воркер, который падает сразу после старта, перезапускается все реже,
+        а не в цикле раз в SHARD_SUPERVISE_INTERVAL.
+        """
+        worker = self._workers[index]
+        if worker.poll() is None:
+            return
+        now = time.monotonic()
+        if self._restart_at[index] is None:
+            if now - self._started_at[index] >= SHARD_RESTART_BACKOFF_RESET:
+                delay = SHARD_RESTART_BACKOFF
+            else:
+                delay = min(max(self._restart_delay[index] * 2, SHARD_RESTART_BACKOFF), SHARD_RESTART_BACKOFF_MAX)
+            self._restart_delay[index] = delay
+            self._restart_at[index] = now + delay
+            # Обновления воркера тем временем ждут в его очереди
+            logger.error(f"Shard worker {index} exited with code {worker.returncode}, restarting in {delay:g}s")
+        if now >= self._restart_at[index]:
+            self._restart_at[index] = None
+            self.restarts += 1
+            self._spawn(index)
+    
+    async def start(self, application):
+        """post_init фронта: запускает воркеров и ждет их готовности до приема обновлений"""
+        self._client = httpx.AsyncClient(timeout=10)
+        for index in range(self.count):
+            self._spawn(index)
+        await asyncio.gather(*(self._wait_ready(index) for index in range(self.count)))
+        
+        loop = asyncio.get_running_loop()
+        self._queues = [asyncio.Queue() for _ in range(self.count)]
+        self._tasks = [loop.create_task(self._forward_loop(index)) for index in range(self.count)]
+        self._tasks.append(loop.create_task(self._supervise()))
+        logger.info(f"All {self.count} shard workers are ready")
+    
+    async def _wait_ready(self, index):
+        """Ждет ответа воркера на /healthz (он грузит данные перед запуском сервера)"""
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        while time.monotonic() < deadline:
+            self._restart_if_dead(index)
+            try:
+                response = await self._client.get(self._url(index, HEALTH_PATH))
+                if response.status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(SHARD_SUPERVISE_INTERVAL)
+        raise RuntimeError(f"Shard worker {index} did not become ready in {SHARD_START_TIMEOUT}s")
+    
+    async def stop(self, application):
+        """post_shutdown фронта: дописывает очереди и останавливает воркеров"""
+        if self._queues:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(q.join() for q in self._queues)), timeout=SHARD_STOP_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                left = sum(q.qsize() for q in self._queues)
+                logger.warning(f"Stopping with {left} updates not forwarded to shard workers")
+        for task in self._tasks:
+            task.cancel()
+        for worker in self._workers:
+            if worker is not None and worker.poll() is None:
+                worker.terminate()
+        deadline = time.monotonic() + SHARD_STOP_TIMEOUT
+        for index, worker in enumerate(self._workers):
+            if worker is None:
+                continue
+            try:
+                worker.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Shard worker {index} did not stop in time, killing")
+                worker.kill()
+        if self._client is not None:
+            await self._client.aclose()
+    
+    async def _supervise(self):
+        next_log = time.monotonic() + SHARD_METRICS_LOG_INTERVAL
+        while True:
+            await asyncio.sleep(SHARD_SUPERVISE_INTERVAL)
+            for index in range(self.count):
+                self._restart_if_dead(index)
+            if time.monotonic() >= next_log:
+                next_log += SHARD_METRICS_LOG_INTERVAL
+                metrics = self.get_metrics()
+                logger.info(f"Shard front: forwarded {metrics['forwarded']}, retries {metrics['retries']}, "
+                            f"rejected {metrics['rejected']}, restarts {metrics['restarts']}, "
+                            f"queued {metrics['queued']}")
+    
+    def get_metrics(self):
+        """Счетчики фронта и число обновлений в очереди каждого воркера"""
+        return {
+            'forwarded': self.forwarded,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'restarts': self.restarts,
+            'queued': [updates.qsize() for updates in self._queues],
+        }
+    
+    @staticmethod
+    def _key(update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return 0
+    
+    async def forward(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик фронта: ставит обновление в очередь воркера его пользователя"""
+        self._queues[shard_of(self._key(update))].put_nowait(update)
+    
+    async def _forward_loop(self, index):
+        """Пересылает обновления из очереди воркера по одному, пока он их не примет"""
+        updates = self._queues[index]
+        url = self._url(index, WEBHOOK_PATH)
+        headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": self.secret}
+        while True:
+            update = await updates.get()
+            try:
+                await self._deliver(index, url, headers, update)
+            finally:
+                updates.task_done()
+    
+    async def _deliver(self, index, url, headers, update):
+        body = update.to_json()
+        delay = SHARD_FORWARD_BACKOFF
+        while True:
+            try:
+                response = await self._client.post(url, content=body, headers=headers)
+                if response.status_code == 200:
+                    self.forwarded += 1
+                    return
+                if response.status_code not in SHARD_RETRY_STATUSES:
+                    # Воркер отверг само обновление (или упал на нем) - повтор ничего не изменит
+                    self.rejected += 1
+                    logger.error(f"Shard worker {index} rejected update {update.update_id}: {response.status_code}")
+                    return
+                logger.warning(f"Shard worker {index} answered {response.status_code}, retrying")
+            except httpx.HTTPError as e:
+                logger.warning(f"Shard worker {index} unavailable, retrying: {e}")
+            self.retries += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SHARD_FORWARD_BACKOFF_MAX)
+
+async def shard_sync_job(context: ContextTypes.DEFAULT_TYPE):
+    """Подтягивает изменения других воркеров (лайки, совпадения, анкеты, баны)"""
+    await sync_data()
+
+async def prune_deletions_job(context: ContextTypes.DEFAULT_TYPE):
+    """Чистит старые записи журнала удалений (их уже прочитали все процессы)"""
+    pruned = await adb.prune_deletions()
+    if pruned:
+        logger.info(f"Pruned {pruned} old deletion log entries")
+
+def run_shard_front(token):
+    """Запускает фронт-процесс, раздающий обновления SHARD_COUNT воркерам"""
+    front = ShardFront()
+    application = application_builder(token).post_init(front.start).post_shutdown(front.stop).build()
+    application.add_handler(TypeHandler(Update, front.forward))
+    
+    print(f"🚀 Фронт запускается ({front.count} воркеров)...")
+    if BOT_MODE == "webhook":
+        run_webhook(application)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+def application_builder(token):
+    """Builder приложения с токеном и (для тестов) адресом Bot API"""
+    builder = Application.builder().token(token)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    return builder
+
+def main() -> None:
+    """Run the bot."""
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     
     if not token:
@@ -2067,8 +5268,38 @@ def main() -> None:
     if not token:
         logger.error("TELEGRAM_BOT_TOKEN environment variable not set.")
         exit(1)
-
-    application = Application.builder().token(token).build()
+    
+    # Фронт шардированного режима сам ничего не обрабатывает - только раздает обновления
+    if SHARD_COUNT > 1 and SHARD_INDEX is None:
+        if BOT_MODE == "webhook" and not WEBHOOK_URL:
+            logger.error("WEBHOOK_URL must be set in webhook mode.")
+            exit(1)
+        run_shard_front(token)
+        return
+    
+    # 🔥 ПРОВЕРЯЕМ И СОЗДАЕМ БАЗУ ДАННЫХ ПРИ СТАРТЕ
+    if not os.path.exists(DB_FILE):
+        print("🆕 Создаю базу данных...")
+        db.init_db()
+    
+    # Загружаем данные при старте
+    load_data()
+    startup_notice()
+    setup_data_persistence()
+    # Резервные копии и снимок индексов общей базы делает один процесс
+    if IS_PRIMARY_PROCESS:
+        backup_manager.start()
+        index_snapshot_manager.start()
+
+    application = (
+        application_builder(token)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .persistence(SQLitePersistence())
+        .post_stop(stop_dispatcher)
+        .build()
+    )
+    # Все исходящие сообщения идут через диспетчер с учетом лимитов Telegram
+    dispatcher.bind(application.bot)
 
     # Add conversation handler with states
     conv_handler = ConversationHandler(
@@ -2083,6 +5314,7 @@ def main() -> None:
             CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirmation)],
             MENU: [
                 MessageHandler(filters.Regex("^Поиск$"), search_profile),
+                MessageHandler(filters.Regex("^💌 Меня лайкнули$"), show_inbox),
                 MessageHandler(filters.Regex("^Настройки$"), settings),
                 MessageHandler(filters.Regex("^⚙️ Админка$"), admin_panel),
             ],
@@ -2119,6 +5351,7 @@ def main() -> None:
                 MessageHandler(filters.Regex("^🟢 Выключить техобслуживание$"), toggle_maintenance),
                 MessageHandler(filters.Regex("^🔴 Включить техобслуживание$"), toggle_maintenance),
                 MessageHandler(filters.Regex("^✏️ Изменить сообщение$"), set_maintenance_message),
+                MessageHandler(filters.Regex("^⏱ Время окончания$"), set_maintenance_end),
                 MessageHandler(filters.Regex("^⬅️ Главное меню$"), back_to_menu),
                 MessageHandler(filters.Regex("^⬅️ Назад в админку$"), back_to_admin),
                 MessageHandler(filters.Regex("^⬅️ Отмена$"), back_to_admin),
@@ -2135,13 +5368,31 @@ def main() -> None:
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.TEXT | filters.PHOTO | filters.Document.ALL, back_to_menu)],
+        # Состояние диалога переживает перезапуск (см. SQLitePersistence)
+        name=CONVERSATION_NAME,
+        persistent=True,
     )
 
+    # Проверка бана и техобслуживания - раз на обновление, до всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, access_guard), group=ACCESS_GUARD_GROUP)
+
     # 🔥 ВАЖНО: Добавляем ОТДЕЛЬНЫЙ обработчик для кнопки "Проверить статус" ВНЕ ConversationHandler
-    application.add_handler(MessageHandler(filters.Regex("^🔄 Проверить статус$"), check_status_handler))
+    application.add_handler(MessageHandler(filters.Regex(f"^{STATUS_BUTTON_TEXT}$"), check_status_handler))
     
     application.add_handler(conv_handler)
-    application.add_handler(CallbackQueryHandler(handle_match_response))
+    application.add_handler(CallbackQueryHandler(handle_match_response, pattern=r"^(like_back|dislike_back)_"))
+    application.add_handler(CallbackQueryHandler(handle_inbox, pattern=r"^inbox_"))
+
+    # Фоновое пополнение колод анкет
+    application.job_queue.run_repeating(refill_decks_job, interval=DECK_REFILL_INTERVAL, first=DECK_REFILL_INTERVAL)
+    # Доставка уведомлений из outbox (first=0 - сразу после старта добираем оставшееся)
+    application.job_queue.run_repeating(drain_outbox_job, interval=OUTBOX_POLL_INTERVAL, first=0)
+    # Воркеру изменения других воркеров никто не принесет - проверяем базу сами
+    if SHARD_INDEX is not None:
+        application.job_queue.run_repeating(shard_sync_job, interval=SHARD_SYNC_INTERVAL, first=SHARD_SYNC_INTERVAL)
+    # Журнал удалений общей базы чистит один процесс
+    if IS_PRIMARY_PROCESS:
+        application.job_queue.run_repeating(prune_deletions_job, interval=DELETIONS_PRUNE_INTERVAL)
 
     # Команды для админов
     application.add_handler(CommandHandler("clear", clear_history_handler))
@@ -2149,12 +5400,21 @@ def main() -> None:
     application.add_handler(CommandHandler("admin", admin_panel))
     application.add_handler(CommandHandler("id", get_user_id))
     application.add_handler(CommandHandler("initdb", init_db_command))
+    application.add_handler(CommandHandler("backup", backup_command))
     application.add_handler(CommandHandler("debug", debug_profile))
 
     # Run the bot until the user presses Ctrl-C
     print("🚀 Бот запускается...")
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if SHARD_INDEX is not None:
+            asyncio.run(run_worker(application))
+        elif BOT_MODE == "webhook":
+            if not WEBHOOK_URL:
+                logger.error("WEBHOOK_URL must be set in webhook mode.")
+                exit(1)
+            run_webhook(application)
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
     except KeyboardInterrupt:
         print("\n🛑 Бот остановлен")
     except Exception as e:
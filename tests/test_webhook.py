@@ -0,0 +1,174 @@
+"""Режим вебхука против локального фейкового Bot API.
+
+Бот запускается отдельным процессом (BOT_MODE=webhook), фейковый API
+принимает его запросы (getMe, setWebhook, sendMessage), а тест шлет
+обновления на вебхук так же, как это делает Telegram.
+"""
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dating_bot.py")
+SECRET = "test-secret"
+START_TIMEOUT = 30
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """Отвечает на методы Bot API и запоминает вызовы: [(метод, параметры)].
+    
+    PTB шлет параметры формой, значения приходят строками.
+    """
+
+    RESULTS = {
+        "getMe": {"id": 1, "is_bot": True, "first_name": "bot", "username": "test_bot"},
+        "sendMessage": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "ok"},
+    }
+
+    def __init__(self):
+        self.calls = []
+        super().__init__(("127.0.0.1", 0), FakeBotAPIHandler)
+
+    def wait_for(self, method, timeout=START_TIMEOUT, **params):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for name, call_params in list(self.calls):
+                if name == method and all(call_params.get(k) == str(v) for k, v in params.items()):
+                    return call_params
+            time.sleep(0.05)
+        raise AssertionError(f"{method} {params} was not called; calls: {[name for name, _ in self.calls]}")
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+        self.server.calls.append((method, params))
+        payload = json.dumps({"ok": True, "result": self.server.RESULTS.get(method, True)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def update(update_id, user_id, text):
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else []
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test", "username": f"user{user_id}"},
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+class WebhookTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.api = FakeBotAPI()
+        threading.Thread(target=cls.api.serve_forever, daemon=True).start()
+        cls.workdir = tempfile.TemporaryDirectory()
+        cls.port = free_port()
+        cls.health_port = free_port()
+        env = dict(
+            os.environ,
+            TELEGRAM_BOT_TOKEN="1:test",
+            TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{cls.api.server_port}",
+            BOT_MODE="webhook",
+            WEBHOOK_URL="https://example.com/telegram",
+            WEBHOOK_LISTEN="127.0.0.1",
+            WEBHOOK_PORT=str(cls.port),
+            WEBHOOK_SECRET=SECRET,
+            HEALTH_PORT=str(cls.health_port),
+        )
+        env.pop("SHARD_INDEX", None)
+        env.pop("SHARD_COUNT", None)
+        cls.bot = subprocess.Popen(
+            [sys.executable, BOT_SCRIPT], cwd=cls.workdir.name, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        # PTB регистрирует вебхук, когда его сервер уже слушает
+        cls.api.wait_for("setWebhook", url="https://example.com/telegram", secret_token=SECRET)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.bot.send_signal(signal.SIGINT)
+        try:
+            cls.bot.wait(START_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            cls.bot.kill()
+            cls.bot.wait()
+        cls.api.shutdown()
+        cls.api.server_close()
+        cls.workdir.cleanup()
+
+    def post(self, body, secret=SECRET):
+        headers = {"Content-Type": "application/json"}
+        if secret is not None:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.port}/telegram", data=body, headers=headers, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_update_with_secret_is_accepted_and_handled(self):
+        status = self.post(json.dumps(update(1, 1001, "/start")).encode())
+        self.assertEqual(status, 200)
+        self.api.wait_for("sendMessage", chat_id=1001)
+
+    def test_wrong_or_missing_secret_is_rejected(self):
+        body = json.dumps(update(2, 1002, "/start")).encode()
+        self.assertEqual(self.post(body, secret="wrong"), 403)
+        self.assertEqual(self.post(body, secret=None), 403)
+        time.sleep(0.5)
+        self.assertFalse([params for name, params in self.api.calls if params.get("chat_id") == "1002"])
+
+    def test_malformed_request_is_rejected(self):
+        with socket.create_connection(("127.0.0.1", self.port), timeout=10) as sock:
+            sock.sendall(
+                b"POST /telegram HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                b"X-Telegram-Bot-Api-Secret-Token: " + SECRET.encode() + b"\r\n"
+                b"Content-Length: abc\r\n\r\n{}"
+            )
+            status_line = sock.recv(1024).split(b"\r\n", 1)[0]
+        self.assertIn(b" 400 ", status_line + b" ")
+
+    def test_health_endpoint(self):
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.health_port}/healthz", timeout=10) as response:
+            self.assertEqual(response.status, 200)
+            health = json.loads(response.read())
+        self.assertTrue(health["ok"])
+        self.assertEqual(health["mode"], "webhook")
+
+
+if __name__ == "__main__":
+    unittest.main()